@@ -0,0 +1,572 @@
+"""ASGI entry point serving the same routes as server.py on an event loop.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+LLM calls go through AsyncOpenAI and replies through an aiohttp session, so a
+single process can hold thousands of in-flight completions. Webhooks are
+acknowledged as soon as their messages are scheduled.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import sqlite3
+import time
+from urllib.parse import parse_qs
+
+import aiohttp
+from openai import AsyncOpenAI, DefaultAioHttpClient
+
+import concurrency
+import conversation
+import debounce
+import dedupe
+import graph
+import metrics
+import payload
+import resilience
+import server
+import signature
+import statuses
+import splitter
+import streaming
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Completions allowed to be waiting on OpenAI at once, and messages allowed to
+# be scheduled (running or waiting for a slot) before /webhook answers 503.
+ASGI_MAX_IN_FLIGHT = int(os.getenv('ASGI_MAX_IN_FLIGHT', '1000'))
+ASGI_MAX_PENDING = int(os.getenv('ASGI_MAX_PENDING', '20000'))
+
+# The SDK's default httpx pool slows down sharply once hundreds of requests
+# are queued on it; aiohttp's does not.
+client = AsyncOpenAI(
+    http_client=DefaultAioHttpClient(), timeout=server.OPENAI_TIMEOUT, max_retries=0,
+)
+# Graph API sessions and, for tenants with their own API key, OpenAI
+# clients, by tenant name.
+_http = {}
+_clients = {}
+_in_flight = asyncio.Semaphore(ASGI_MAX_IN_FLIGHT)
+# With ADAPTIVE_CONCURRENCY the in-flight cap adapts below ASGI_MAX_IN_FLIGHT.
+llm_limiter = concurrency.from_env(
+    concurrency.AsyncAdaptiveLimiter, 'llm', server.OPENAI_OVERLOAD_ERRORS, max_limit=ASGI_MAX_IN_FLIGHT,
+)
+_tasks = set()
+# Messages scheduled per tenant, and the slots of tenants with workers.
+_tenant_pending = collections.Counter()
+_tenant_slots = {}
+# With INBOX_PATH set, webhooks only write messages to the inbox; a task per
+# tenant with workers, and one for the rest, claims up to INBOX_CLAIM_BATCH
+# at a time while fewer than ASGI_MAX_PENDING are being answered.
+INBOX_CLAIM_BATCH = 100
+_inbox_ready = set()
+_inbox_drainers = []
+ROUTES = ('/', '/webhook', '/metrics')
+# ASGI header names arrive lowercased as bytes.
+SIGNATURE_HEADER = signature.HEADER.lower().encode()
+
+
+def http_client(tenant=server.default_tenant):
+    # aiohttp sessions must be created inside the running event loop. Each
+    # tenant has its own, so none can hold all the connections.
+    session = _http.get(tenant.name)
+    if session is None:
+        session = _http[tenant.name] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=tenant.graph_pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=graph.GRAPH_CONNECT_TIMEOUT, sock_read=graph.GRAPH_READ_TIMEOUT),
+        )
+    return session
+
+
+def openai_client(tenant):
+    if tenant.openai_api_key is None:
+        return client
+    tenant_client = _clients.get(tenant.name)
+    if tenant_client is None:
+        tenant_client = _clients[tenant.name] = AsyncOpenAI(
+            api_key=tenant.openai_api_key, http_client=DefaultAioHttpClient(),
+            timeout=server.OPENAI_TIMEOUT, max_retries=0,
+        )
+    return tenant_client
+
+
+def tenant_slot(tenant):
+    """At most tenant.workers of a tenant's messages are answered at once
+    when it has workers of its own."""
+    if tenant.workers <= 0:
+        return contextlib.nullcontext()
+    slot = _tenant_slots.get(tenant.name)
+    if slot is None:
+        slot = _tenant_slots[tenant.name] = asyncio.Semaphore(tenant.workers)
+    return slot
+
+
+def llm_slot():
+    return llm_limiter.slot() if llm_limiter is not None else _in_flight
+
+
+def call_openai(operation):
+    return resilience.call_async(
+        operation, 'openai', server.openai_retry_policy, server.openai_breaker, server.classify_openai_error,
+    )
+
+
+# Stores kept in SQLite can wait up to their 30 s busy timeout for another
+# process's lock, which would stall every request on the loop, so calls to
+# them are made from a thread. In-memory stores are called directly.
+SQLITE_STORES = (dedupe.SQLiteDedupeStore, debounce.SQLiteCoalescer, conversation.SQLiteConversationStore)
+
+
+async def store_call(store, fn, *args):
+    if isinstance(store, SQLITE_STORES):
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+async def chat_ai(query, history=(), tenant=server.default_tenant):
+    messages = server.build_messages(query, history, tenant.system_prompt)
+
+    async def attempt():
+        async with llm_slot():
+            return await openai_client(tenant).chat.completions.create(model=tenant.model, messages=messages)
+
+    started = time.monotonic()
+    with tracing.span('llm', model=tenant.model):
+        completion = await call_openai(attempt)
+    metrics.observe('stage_seconds', time.monotonic() - started, stage='llm')
+    server.record_usage(completion.usage, tenant)
+    return completion.choices[0].message.content
+
+
+async def open_stream(messages, tenant=server.default_tenant):
+    async with contextlib.AsyncExitStack() as stack:
+        await stack.enter_async_context(llm_slot())
+        stream = await openai_client(tenant).chat.completions.create(
+            model=tenant.model, messages=messages, stream=True, stream_options={"include_usage": True},
+        )
+        return stack.pop_all(), stream
+
+
+async def read_stream(messages, tenant=server.default_tenant):
+    started = time.monotonic()
+    with tracing.span('llm', model=tenant.model, stream=True):
+        slot, stream = await call_openai(lambda: open_stream(messages, tenant))
+        async with slot:
+            async for chunk in stream:
+                server.record_usage(chunk.usage, tenant)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    metrics.observe('stage_seconds', time.monotonic() - started, stage='llm')
+
+
+async def chat_ai_stream(query, history=(), tenant=server.default_tenant):
+    """Like server.chat_ai_stream: a task reads the stream so sends made in
+    between do not count as LLM time."""
+    messages = server.build_messages(query, history, tenant.system_prompt)
+    deltas = asyncio.Queue()
+
+    async def read():
+        try:
+            async for delta in read_stream(messages, tenant):
+                deltas.put_nowait(delta)
+        except Exception as exc:
+            deltas.put_nowait(exc)
+        finally:
+            deltas.put_nowait(None)
+
+    reader = asyncio.get_running_loop().create_task(read())
+    try:
+        while True:
+            delta = await deltas.get()
+            if delta is None:
+                return
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+    finally:
+        if not reader.done():
+            reader.cancel()
+
+
+def classify_graph_error(exc):
+    # Same rules as graph.classify: retry connect failures, not read timeouts.
+    if isinstance(exc, aiohttp.ConnectionTimeoutError):
+        return resilience.Transient()
+    if isinstance(exc, asyncio.TimeoutError):
+        return resilience.Transient(retry=False)
+    if isinstance(exc, aiohttp.ClientConnectionError):
+        return resilience.Transient()
+    return None
+
+
+async def send_text(phone_number_id, to, text):
+    tenant = server.tenants.get(phone_number_id)
+
+    async def attempt():
+        if graph.pacer is not None:
+            await graph.pacer.wait_async(phone_number_id, to)
+        async with http_client(tenant).post(
+            graph.messages_url(phone_number_id),
+            json=graph.text_message(to, text),
+            headers=graph.auth_headers(tenant.token),
+        ) as response:
+            body = await response.read()
+            return graph.check_status(response, response.status, response.headers, body, phone_number_id, to)
+
+    started = time.monotonic()
+    try:
+        with tracing.span('graph.send', phone_number_id=phone_number_id):
+            return await resilience.call_async(
+                attempt, 'graph', graph.retry_policy, graph.breaker, classify_graph_error,
+            )
+    finally:
+        metrics.observe('stage_seconds', time.monotonic() - started, stage='send')
+
+
+async def send_reply(phone_number_id, from_number, x, index=0, started=None):
+    for part in splitter.split_message(server.reply_text(x, index)):
+        response = await send_text(phone_number_id, from_number, part)
+        if started is not None:
+            metrics.observe('time_to_first_message_seconds', time.monotonic() - started)
+            started = None
+        if not response.ok:
+            break
+    return response
+
+
+async def stream_answer(phone_number_id, from_number, msg_body, history, tenant=server.default_tenant):
+    reply = streaming.StreamedReply(server.STREAM_MIN_CHUNK_CHARS)
+    responses = []
+    try:
+        async for delta in chat_ai_stream(msg_body, history, tenant):
+            for index, chunk in reply.push(delta):
+                responses.append(await send_reply(phone_number_id, from_number, chunk, index))
+                reply.sent(chunk)
+    except Exception as exc:
+        if reply.sent_text and server.llm_unavailable(exc):
+            raise streaming.CutOff(reply.sent_text, responses, exc) from exc
+        raise
+    for index, chunk in reply.finish():
+        responses.append(await send_reply(phone_number_id, from_number, chunk, index))
+        reply.sent(chunk)
+    return reply.text, responses
+
+
+async def send_fallback(phone_number_id, from_number):
+    metrics.inc('llm_fallback_replies')
+    if server.FALLBACK_REPLY:
+        return await send_text(phone_number_id, from_number, server.FALLBACK_REPLY)
+    return None
+
+
+async def process_message(phone_number_id, from_number, msg_body, received=None, message_id=None):
+    tenant = server.tenants.get(phone_number_id)
+    async with tenant_slot(tenant):
+        started = time.monotonic()
+        metrics.inc('tenant_messages', tenant=tenant.name)
+        if received is not None:
+            metrics.observe('stage_seconds', started - received, stage='queue')
+        try:
+            with tracing.span('message', message_id, phone_number_id=phone_number_id, tenant=tenant.name):
+                return await answer_message(phone_number_id, from_number, msg_body, started, tenant)
+        except Exception:
+            metrics.inc('message_errors', tenant=tenant.name)
+            raise
+        finally:
+            elapsed = time.monotonic() - (received or started)
+            metrics.observe('stage_seconds', elapsed, stage='end_to_end')
+            metrics.observe('tenant_message_seconds', elapsed, tenant=tenant.name)
+
+
+async def answer_message(phone_number_id, from_number, msg_body, started, tenant=server.default_tenant):
+    limited = tenant.limits.check(phone_number_id, from_number)
+    if limited is not None:
+        return await send_text(phone_number_id, from_number, limited) if limited else None
+    key = server.conversation_key(phone_number_id, from_number)
+    conversations = server.conversations
+    history = await store_call(conversations, conversations.history, key) if conversations is not None else ()
+    cached = server.cache_key(phone_number_id, msg_body, history)
+    x = server.lookup_cached(cached, msg_body)
+    responses = []
+    if x is None:
+        try:
+            if server.STREAM_REPLIES:
+                x, responses = await stream_answer(phone_number_id, from_number, msg_body, history, tenant)
+            else:
+                x = await chat_ai(msg_body, history, tenant)
+        except streaming.CutOff as exc:
+            # Part of the answer has been sent; the fallback reply after it
+            # would contradict it. Keep what the user saw as the answer.
+            logger.warning('%s', exc)
+            metrics.inc('llm_answers_cut_off')
+            if conversations is not None:
+                await store_call(conversations, conversations.record_exchange, key, msg_body, exc.text)
+            return exc.responses[-1]
+        except Exception as exc:
+            if not server.llm_unavailable(exc):
+                raise
+            logger.warning('no answer from OpenAI, sending the fallback reply: %r', exc)
+            return await send_fallback(phone_number_id, from_number)
+        server.store_cached(cached, msg_body, x)
+    if conversations is not None:
+        await store_call(conversations, conversations.record_exchange, key, msg_body, x)
+    if not responses:
+        responses.append(await send_reply(phone_number_id, from_number, x, started=started))
+    return responses[-1]
+
+
+async def answer_held(key):
+    """Wait for key's DEBOUNCE_SECONDS window to close, then answer the
+    messages it holds as one."""
+    coalescer = server.coalescer
+    delay = await store_call(coalescer, coalescer.remaining, key)
+    while delay > 0:
+        await asyncio.sleep(delay)
+        delay = await store_call(coalescer, coalescer.remaining, key)
+    pending = await store_call(coalescer, coalescer.take, key)
+    if pending is None:
+        # Shared windows: another process took it first.
+        return
+    await process_message(*key, pending.text, pending.received, pending.message_id)
+
+
+async def persist_jobs(jobs):
+    inbox = server.message_inbox
+    future = inbox.put([(message_id, args[:3]) for message_id, args in jobs])
+    try:
+        # Shielded: cancelling the Future would not stop the write.
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), server.INBOX_PUT_TIMEOUT)
+    except asyncio.TimeoutError:
+        server.inbox_write_late(future, jobs)
+        return False
+    except Exception:
+        logger.exception('could not write messages to the inbox')
+        await store_call(server.dedupe_store, server.forget_messages, [message_id for message_id, _ in jobs])
+        return False
+    for ready in _inbox_ready:
+        ready.set()
+    return True
+
+
+async def answer_claimed(inbox, item):
+    try:
+        await process_message(*item.args, received=item.received(), message_id=item.message_id)
+    except asyncio.CancelledError:
+        # Still claimed, so it is answered again after the restart.
+        raise
+    except Exception:
+        inbox.complete([item.row_id])
+        raise
+    inbox.complete([item.row_id])
+
+
+async def drain_inbox(inbox, tenant=None, numbers=None, excluding=()):
+    """Claim and answer inbox messages; with tenant, only those to numbers,
+    keeping at most its workers plus queue_size of them scheduled."""
+    ready = asyncio.Event()
+    _inbox_ready.add(ready)
+    while True:
+        room = ASGI_MAX_PENDING - len(_tasks)
+        if tenant is not None:
+            room = min(room, tenant.workers + tenant.queue_size - _tenant_pending[tenant.name])
+        if room <= 0:
+            await asyncio.wait(list(_tasks), return_when=asyncio.FIRST_COMPLETED)
+            continue
+        ready.clear()
+        try:
+            claimed = await asyncio.shield(
+                asyncio.wrap_future(inbox.claim(min(room, INBOX_CLAIM_BATCH), numbers, excluding)),
+            )
+        except sqlite3.Error:
+            metrics.inc('inbox_errors')
+            await asyncio.sleep(inbox.poll_interval)
+            continue
+        for item in claimed:
+            schedule_for(server.tenants.get(item.args[0]), answer_claimed(inbox, item))
+        if not claimed:
+            # Polling picks up other processes' messages and expired leases.
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(ready.wait(), inbox.poll_interval)
+
+
+def start_draining(inbox):
+    """One drainer for each tenant with workers and one for everyone else,
+    as server.start_inbox() starts threads."""
+    loop = asyncio.get_running_loop()
+    excluding = []
+    for _, _, numbers in server.inbox_groups():
+        tenant = server.tenants.get(numbers[0])
+        _inbox_drainers.append(loop.create_task(drain_inbox(inbox, tenant, numbers)))
+        excluding += numbers
+    _inbox_drainers.append(loop.create_task(drain_inbox(inbox, excluding=excluding)))
+
+
+def _task_done(task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('message processing failed', exc_info=task.exception())
+
+
+def schedule(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+
+def tenant_full(tenant):
+    return tenant.workers > 0 and _tenant_pending[tenant.name] >= tenant.workers + tenant.queue_size
+
+
+def schedule_for(tenant, coro):
+    _tenant_pending[tenant.name] += 1
+
+    def done(task):
+        _tenant_pending[tenant.name] -= 1
+
+    schedule(coro).add_done_callback(done)
+
+
+async def webhook(parsed, received=None, span=None):
+    events = server.events
+    if events is not None:
+        events.log('webhook', payload=parsed.body)
+    if not parsed.is_whatsapp:
+        return 404, b''
+
+    jobs = await store_call(server.dedupe_store, server.collect_jobs, parsed, received)
+    if jobs and span is not None:
+        span.message_id = jobs[0][0]
+    if server.message_inbox is not None:
+        if jobs and not await persist_jobs(jobs):
+            if events is not None:
+                events.log('webhook_rejected', reason='inbox_unavailable', messages=len(jobs))
+            return 503, b''
+        return 200, b''
+    rejected = []
+    for message_id, args in jobs:
+        tenant = server.tenants.get(args[0])
+        if len(_tasks) >= ASGI_MAX_PENDING or tenant_full(tenant):
+            metrics.inc('tenant_rejected', tenant=tenant.name)
+            rejected.append(message_id)
+            continue
+        if server.coalescer is not None:
+            # The first message of a window schedules its answer; later ones
+            # only push the window back.
+            key = server.conversation_key(args[0], args[1])
+            if await store_call(server.coalescer, server.coalescer.add, key, *args[2:]):
+                schedule_for(tenant, answer_held(key))
+            continue
+        schedule_for(tenant, process_message(*args))
+    if rejected:
+        await store_call(server.dedupe_store, server.forget_messages, rejected)
+        if events is not None:
+            events.log('webhook_rejected', reason='too_many_pending', messages=len(rejected))
+        return 503, b''
+    return 200, b''
+
+
+def verify_webhook(query_string):
+    params = parse_qs(query_string.decode())
+    verify_token = params.get('hub.verify_token', [None])[0]
+    challenge = params.get('hub.challenge', [''])[0]
+    if verify_token == server.VERIFY_TOKEN:
+        return 200, challenge.encode()
+    return 403, b'Invalid Verify Token'
+
+
+def header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def respond(send, status, body, content_type=b'text/html; charset=utf-8'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            http_client()
+            if server.message_inbox is not None:
+                start_draining(server.message_inbox)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for drainer in _inbox_drainers:
+                drainer.cancel()
+            if _tasks:
+                await asyncio.wait(list(_tasks), timeout=graph.GRAPH_READ_TIMEOUT)
+            for session in _http.values():
+                await session.close()
+            for tenant_client in _clients.values():
+                await tenant_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    path, method = scope['path'], scope['method']
+    route = path if path in ROUTES else 'unmatched'
+    content_type = b'text/html; charset=utf-8'
+    if path == '/webhook' and method == 'POST':
+        received = time.monotonic()
+        raw = await read_body(receive)
+        if server.verifier is not None and not server.verifier.verify(raw, header(scope, SIGNATURE_HEADER)):
+            status, body = 401, b''
+        elif server.STATUS_FAST_PATH and statuses.is_status_only(raw):
+            server.queue_statuses(raw)
+            status, body = 200, b''
+        else:
+            with tracing.span('webhook') as span:
+                try:
+                    parsed = payload.parse(raw)
+                except ValueError:
+                    parsed = None
+                metrics.observe('stage_seconds', time.monotonic() - received, stage='parse')
+                if parsed is None:
+                    status, body = 400, b''
+                else:
+                    status, body = await webhook(parsed, received, span)
+    elif path == '/metrics' and method == 'GET':
+        metrics.set_gauge('pending_messages', len(_tasks))
+        for name, pending in _tenant_pending.items():
+            metrics.set_gauge('tenant_pending_messages', pending, tenant=name)
+        if server.message_inbox is not None:
+            metrics.set_gauge('inbox_depth', await asyncio.to_thread(server.message_inbox.depth))
+        if server.coalescer is not None:
+            metrics.set_gauge('debounce_pending', await store_call(server.coalescer, len, server.coalescer))
+        status, body = 200, metrics.render().encode()
+        content_type = b'text/plain; version=0.0.4; charset=utf-8'
+    elif path == '/webhook' and method == 'GET':
+        status, body = verify_webhook(scope.get('query_string', b''))
+    elif path == '/' and method == 'GET':
+        status, body = 200, b'Hello World!'
+    elif route != 'unmatched':
+        status, body = 405, b''
+    else:
+        status, body = 404, b''
+    metrics.inc('http_requests', route=route, method=method, status=status)
+    await respond(send, status, body, content_type)
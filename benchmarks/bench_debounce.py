@@ -0,0 +1,151 @@
+"""LLM calls and replies when senders split questions over several messages.
+
+    python benchmarks/bench_debounce.py --senders 50 --fragments 4 --windows 0,1.5
+    python benchmarks/bench_debounce.py --server gunicorn --workers 4 --backends memory,sqlite
+
+Each simulated sender types one question as --fragments messages with
+--gap seconds (on average, exponentially distributed) between them, all
+senders at once. Every window in --windows is run with DEBOUNCE_SECONDS set
+to it (0 turns coalescing off) and each of --backends as DEBOUNCE_BACKEND.
+With --server flask it goes through the Flask app with background workers
+in this process; gunicorn and uvicorn are started by run.py with --workers
+processes, which webhooks reach in turn, as in production. The report shows
+completions requested, replies sent and, per sender, the time from its last
+fragment to the last reply it got.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_servers import free_port, payload, percentile, sender, start_server  # noqa: E402
+from stubs import graph_stub, openai_stub  # noqa: E402
+
+
+def fragment(i, text, frm):
+    body = payload(i)
+    body['entry'][0]['changes'][0]['value']['messages'][0]['from'] = frm
+    body['entry'][0]['changes'][0]['value']['messages'][0]['text']['body'] = text
+    return json.dumps(body)
+
+
+def run(window, backend, post, openai, whatsapp, args, offset):
+    openai.reset_counts()
+    whatsapp.reset_counts()
+    last_sent = {}
+
+    def type_question(s):
+        frm = sender(offset + s)
+        rng = random.Random(s)
+        for f in range(args.fragments):
+            i = (offset + s) * args.fragments + f
+            post(fragment(i, f'part {f} of my question', frm))
+            last_sent[frm] = time.perf_counter()
+            if f < args.fragments - 1:
+                time.sleep(rng.expovariate(1 / args.gap))
+
+    threads = [threading.Thread(target=type_question, args=(s,)) for s in range(args.senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Wait until replies stop arriving.
+    count = -1
+    while count != whatsapp.requests:
+        count = whatsapp.requests
+        time.sleep(max(1.0, window * 2))
+    waits = sorted(max(whatsapp.deliveries[frm]) - sent for frm, sent in last_sent.items() if frm in whatsapp.deliveries)
+    print(
+        f'{window:>7.1f} {backend if window > 0 else "":<8} {openai.requests:>10} {whatsapp.requests:>8} '
+        + ' '.join(f'{percentile(waits, q) * 1000:>8.0f}' for q in (0.5, 0.95, 0.99))
+    )
+
+
+def in_process(window, backend, args, directory):
+    """post() through the Flask app in this process."""
+    import debounce
+    import server
+    if window <= 0:
+        server.coalescer = None
+    elif backend == 'sqlite':
+        server.coalescer = debounce.SQLiteCoalescer(os.path.join(directory, f'{window}.sqlite3'), window, args.max_wait)
+    else:
+        server.coalescer = debounce.Coalescer(window, args.max_wait)
+    client = server.app.test_client()
+
+    def post(body):
+        client.post('/webhook', data=body, content_type='application/json')
+    return post, None
+
+
+def subprocess_server(window, backend, args, directory):
+    """post() to args.server started by run.py with args.workers processes."""
+    port = free_port()
+    env = dict(
+        os.environ, VERIFY_TOKEN='bench', WEB_CONCURRENCY=str(args.workers),
+        DEBOUNCE_SECONDS=str(window), DEBOUNCE_BACKEND=backend,
+        DEBOUNCE_SQLITE_PATH=os.path.join(directory, f'{window}.sqlite3'),
+    )
+    proc = start_server(args.server, port, env)
+    url = f'http://127.0.0.1:{port}/webhook'
+    client = httpx.Client(timeout=30)
+
+    def post(body):
+        client.post(url, content=body, headers={'Content-Type': 'application/json'})
+    return post, proc
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--senders', type=int, default=50)
+    parser.add_argument('--fragments', type=int, default=4)
+    parser.add_argument('--gap', type=float, default=0.6, help='mean seconds between fragments')
+    parser.add_argument('--windows', default='0,0.5,1.5')
+    parser.add_argument('--backends', default='memory', help='DEBOUNCE_BACKEND values to compare')
+    parser.add_argument('--max-wait', type=float, default=5, help='DEBOUNCE_MAX_SECONDS')
+    parser.add_argument('--llm-latency', type=float, default=0.8)
+    parser.add_argument('--server', choices=('flask', 'gunicorn', 'uvicorn'), default='flask')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes for gunicorn and uvicorn')
+    args = parser.parse_args()
+
+    openai = openai_stub(args.llm_latency).start()
+    whatsapp = graph_stub().start()
+    os.environ.update({
+        'OPENAI_API_KEY': 'stub', 'OPENAI_BASE_URL': openai.url + '/v1',
+        'WHATSAPP_TOKEN': 'stub', 'GRAPH_API_URL': whatsapp.url + '/v18.0',
+        'BACKGROUND_WORKERS': str(args.senders), 'SENDER_RATE_PER_MINUTE': '0', 'RESPONSE_CACHE_SIZE': '0',
+        'GRAPH_NUMBER_RATE_PER_SECOND': '0', 'GRAPH_RECIPIENT_RATE_PER_MINUTE': '0', 'LOG_SINK': 'none',
+    })
+    start = in_process if args.server == 'flask' else subprocess_server
+    directory = tempfile.mkdtemp()
+
+    print(f'{"":<37} {"last fragment to last reply ms":^26}')
+    print(f'{"window":>7} {"backend":<8} {"LLM calls":>10} {"replies":>8} {"p50":>8} {"p95":>8} {"p99":>8}')
+    runs = []
+    for window in (float(w) for w in args.windows.split(',')):
+        # Without coalescing the backend makes no difference; run it once.
+        runs += [(window, backend) for backend in args.backends.split(',')] if window > 0 else [(window, 'memory')]
+    try:
+        for n, (window, backend) in enumerate(runs):
+            post, proc = start(window, backend, args, directory)
+            try:
+                run(window, backend, post, openai, whatsapp, args, n * args.senders)
+            finally:
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
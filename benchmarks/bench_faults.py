@@ -0,0 +1,77 @@
+"""Replies, fallbacks and latency while the OpenAI stub injects faults.
+
+    python benchmarks/bench_faults.py --messages 200 --threads 16
+
+Runs process_message in this process against the stubs, through a series of
+phases: healthy, 30% 500s, 30% 429s with Retry-After, a full outage (the
+breaker opens and messages get the fallback reply quickly) and recovery.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stubs import graph_stub, openai_stub  # noqa: E402
+
+PHASES = [
+    ('healthy', {}),
+    ('500s 30%', {'fail_rate': 0.3}),
+    ('429s 30%', {'fail_rate': 0.3, 'fail_status': 429, 'retry_after': 0.2}),
+    ('outage', {'fail_rate': 1.0}),
+    ('recovery', {}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200, help='messages per phase')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--llm-latency', type=float, default=0.05)
+    parser.add_argument('--reset-seconds', type=float, default=1.0, help='BREAKER_RESET_SECONDS')
+    args = parser.parse_args()
+
+    openai = openai_stub(args.llm_latency).start()
+    whatsapp = graph_stub().start()
+    os.environ.update({
+        'OPENAI_API_KEY': 'stub', 'OPENAI_BASE_URL': openai.url + '/v1',
+        'WHATSAPP_TOKEN': 'stub', 'GRAPH_API_URL': whatsapp.url + '/v18.0',
+        'SENDER_RATE_PER_MINUTE': '0', 'RESPONSE_CACHE_SIZE': '0', 'CONVERSATION_TOKEN_BUDGET': '0',
+        'GRAPH_NUMBER_RATE_PER_SECOND': '0', 'GRAPH_RECIPIENT_RATE_PER_MINUTE': '0',
+        'RETRY_BASE_DELAY': os.getenv('RETRY_BASE_DELAY', '0.05'),
+        'BREAKER_RESET_SECONDS': str(args.reset_seconds),
+    })
+    import metrics
+    import server
+
+    def timed(i):
+        start = time.perf_counter()
+        server.process_message('1234', f'1555{i:07d}', f'question {i}')
+        return time.perf_counter() - start
+
+    print(f'{"phase":<10} {"answered":>9} {"fallback":>9} {"llm reqs":>9} {"mean ms":>8} {"p99 ms":>7} {"breaker":>10}')
+    for phase, faults in PHASES:
+        if phase == 'recovery':
+            time.sleep(args.reset_seconds)
+        openai.options.update({'fail_rate': 0, 'fail_status': 500, 'retry_after': None}, **faults)
+        openai.reset_counts()
+        fallbacks = metrics.get('llm_fallback_replies')
+        with ThreadPoolExecutor(args.threads) as pool:
+            latencies = sorted(pool.map(timed, range(args.messages)))
+        fallbacks = metrics.get('llm_fallback_replies') - fallbacks
+        print(
+            f'{phase:<10} {args.messages - fallbacks:>9} {fallbacks:>9} {openai.requests:>9} '
+            f'{statistics.mean(latencies) * 1000:>8.1f} '
+            f'{latencies[int(len(latencies) * 0.99)] * 1000:>7.1f} '
+            f'{server.openai_breaker.state:>10}'
+        )
+
+    openai.stop()
+    whatsapp.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Compare bare requests.post against the pooled Graph session.
+
+    python benchmarks/bench_graph_session.py --sends 2000 --threads 8
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import requests  # noqa: E402
+
+import graph  # noqa: E402
+from stubs import graph_stub  # noqa: E402
+
+# Every send goes to one recipient; pacing would measure Meta's limits
+# rather than the connections (benchmarks/bench_pacing.py covers those).
+graph.pacer = None
+
+
+def bare_send(phone_number_id, to, text, token):
+    # What server.py did before the pooled session: a new connection per send.
+    return requests.post(
+        f"{graph.GRAPH_API_URL}/{phone_number_id}/messages?access_token={token}",
+        json={"messaging_product": "whatsapp", "to": to, "text": {"body": text}},
+        headers={"Content-Type": "application/json"},
+    )
+
+
+def run(send, sends, threads):
+    def timed(i):
+        start = time.perf_counter()
+        send('1234', '15550001111', f'answer {i}', 'token').raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        latencies = sorted(pool.map(timed, range(sends)))
+    return time.perf_counter() - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sends', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='stub response delay in seconds')
+    args = parser.parse_args()
+
+    with graph_stub(args.latency) as stub:
+        graph.GRAPH_API_URL = stub.url + '/v18.0'
+        print(f'{"mode":<8} {"sends/s":>9} {"mean ms":>8} {"p50 ms":>7} {"p99 ms":>7} {"conns":>6}')
+        for name, send in (('bare', bare_send), ('pooled', graph.send_text)):
+            stub.reset_counts()
+            elapsed, latencies = run(send, args.sends, args.threads)
+            print(
+                f'{name:<8} {args.sends / elapsed:>9.0f} '
+                f'{statistics.mean(latencies) * 1000:>8.2f} '
+                f'{latencies[len(latencies) // 2] * 1000:>7.2f} '
+                f'{latencies[int(len(latencies) * 0.99)] * 1000:>7.2f} '
+                f'{stub.connections:>6}'
+            )
+
+
+if __name__ == '__main__':
+    main()
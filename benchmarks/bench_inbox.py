@@ -0,0 +1,77 @@
+"""Enqueue and dequeue rates of the durable inbox.
+
+    python benchmarks/bench_inbox.py --messages 5000 --threads 1,16,64
+
+Producers call put() with one message each, as concurrent webhooks do, and
+wait for it to commit. Consumers claim, run a no-op handler and complete
+messages the way INBOX_WORKERS threads do. Both are run with
+INBOX_BATCH_SIZE=1 (a commit per operation) and with group commits, under
+PRAGMA synchronous=NORMAL (survives a process crash) and FULL (also
+survives power loss).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import inbox  # noqa: E402
+import metrics  # noqa: E402
+
+
+def enqueue(box, messages, threads):
+    def produce(i):
+        box.put([(f'wamid.{i}', ['1234', f'1555{i:07d}', 'how do I reset my password?'])]).result()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(produce, range(messages)))
+    return messages / (time.perf_counter() - start)
+
+
+def dequeue(box, messages, threads):
+    done = threading.Semaphore(0)
+    box.poll_interval = 0.01
+    start = time.perf_counter()
+    box.start(lambda *args, **kwargs: done.release(), threads)
+    for _ in range(messages):
+        done.acquire()
+    # The last completions are queued behind the handler; wait for them.
+    while box.depth():
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    # Park the consumers so they do not poll during later runs.
+    box.poll_interval = 3600
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--threads', default='1,16,64')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    print(f'{"synchronous":<12} {"batch":>6} {"threads":>8} {"enqueue/s":>10} {"dequeue/s":>10} {"ops/commit":>11}')
+    try:
+        for synchronous in ('NORMAL', 'FULL'):
+            for batch_size in (1, 500):
+                for threads in (int(t) for t in args.threads.split(',')):
+                    path = os.path.join(directory, f'{synchronous}-{batch_size}-{threads}.sqlite3')
+                    box = inbox.Inbox(path, batch_size=batch_size, synchronous=synchronous)
+                    commits = metrics.get('inbox_commits')
+                    put_rate = enqueue(box, args.messages, threads)
+                    get_rate = dequeue(box, args.messages, threads)
+                    ops = args.messages * 3 / (metrics.get('inbox_commits') - commits)
+                    print(f'{synchronous:<12} {batch_size:>6} {threads:>8} {put_rate:>10.0f} {get_rate:>10.0f} {ops:>11.1f}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
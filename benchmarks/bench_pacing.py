@@ -0,0 +1,99 @@
+"""Outbound sends against a Graph stub that enforces Meta's send limits.
+
+    python benchmarks/bench_pacing.py --number-rate 80 --threads 64
+
+Sends go through graph.send_text() from many threads at once, like replies
+from a burst of webhooks, to a stub that refuses sends over the per-number
+or per-recipient limit with error 130429 or 131056. Two loads are sent:
+replies to many recipients, limited by the business number's rate, and
+replies to a few recipients, limited by the per-recipient rate. That limit
+is scaled to --pair-rate sends a second (Meta's is about one every 6
+seconds) so the run takes seconds rather than minutes. Each load runs
+without pacing, relying on retries, and with the pacer set to the stub's
+limits. The report shows throughput, the time the delivered sends needed
+at best under the limits as a share of the time taken, violations, retries
+and sends that never got through.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from stubs import graph_stub  # noqa: E402
+
+
+def ideal_seconds(sends, rate, burst):
+    return max(0.0, (sends - burst) / rate)
+
+
+def run(label, graph_module, stub, pacer, sends, recipients, threads, limit):
+    import metrics
+
+    graph_module.pacer = pacer
+    stub.reset_counts()
+    retries = metrics.get('graph_retries')
+
+    def send(i):
+        # phone_number_id 1234; recipients take turns, so each gets an equal share.
+        response = graph_module.send_text('1234', f'1555{i % recipients:07d}', 'Answer from AI -> ok', 'bench')
+        return response.ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        delivered = sum(pool.map(send, range(sends)))
+    elapsed = time.perf_counter() - start
+    ideal = ideal_seconds(delivered, *limit)
+    print(
+        f'{label:<22} {delivered / elapsed:>8.1f} {ideal / elapsed:>9.0%} {stub.violations:>10} '
+        f'{metrics.get("graph_retries") - retries:>8} {sends - delivered:>7}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number-rate', type=float, default=80, help='sends a second per business number')
+    parser.add_argument('--pair-rate', type=float, default=5, help='sends a second per recipient, scaled down')
+    parser.add_argument('--pair-burst', type=float, default=5)
+    parser.add_argument('--slack', type=float, default=0.1, help='GRAPH_PACING_SLACK')
+    parser.add_argument('--sends', type=int, default=1200)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--graph-latency', default='lognormal:0.02,0.5')
+    args = parser.parse_args()
+
+    stub = graph_stub(
+        args.graph_latency, number_rate=args.number_rate, number_burst=args.number_rate,
+        pair_rate=args.pair_rate, pair_burst=args.pair_burst,
+    ).start()
+    os.environ['GRAPH_API_URL'] = stub.url + '/v18.0'
+    os.environ['GRAPH_POOL_SIZE'] = str(args.threads)
+    os.environ['BREAKER_FAILURE_THRESHOLD'] = '0'
+    import graph
+    import pacing
+
+    def pacer():
+        return pacing.Pacer(
+            pacing.Schedule(args.number_rate, args.number_rate, slack=args.slack),
+            pacing.Schedule(args.pair_rate, args.pair_burst, slack=args.slack),
+        )
+
+    loads = [
+        # Many recipients: a few sends each, so only the number's limit binds.
+        ('many recipients', args.sends, args.sends // 4, (args.number_rate, args.number_rate)),
+        # Ten recipients sent several seconds' worth each, so their limit binds.
+        ('few recipients', int(10 * (args.pair_burst + 4 * args.pair_rate)), 10,
+         (10 * args.pair_rate, 10 * args.pair_burst)),
+    ]
+    print(f'{"load":<22} {"sends/s":>8} {"of ideal":>9} {"violations":>10} {"retries":>8} {"failed":>7}')
+    try:
+        for name, sends, recipients, limit in loads:
+            for mode, make in (('unpaced', lambda: None), ('paced', pacer)):
+                run(f'{name}, {mode}', graph, stub, make(), sends, recipients, args.threads, limit)
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
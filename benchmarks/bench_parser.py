@@ -0,0 +1,104 @@
+"""Webhook parsing: chained dict access versus payload.parse().
+
+    python benchmarks/bench_parser.py --batch 1000
+
+Times, per payload, decoding the raw body and pulling out every text message
+for a single-message webhook, a delivery receipt and one large batch. The
+baseline is how server.py used to read payloads: json.loads, then chained
+body['entry'][0]['changes'][0]['value'] lookups, which only ever saw the
+first message. The dict walk visits every message with .get() chains.
+payload.parse() is timed with the standard json module and, when installed,
+with orjson.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_servers import payload as message_payload, status_payload  # noqa: E402
+
+import payload  # noqa: E402
+
+
+def batch_payload(size):
+    # Meta batches up to a few hundred updates per POST under load.
+    body = message_payload(0)
+    value = body['entry'][0]['changes'][0]['value']
+    value['messages'] = [message_payload(i)['entry'][0]['changes'][0]['value']['messages'][0] for i in range(size)]
+    value['contacts'] = [message_payload(i)['entry'][0]['changes'][0]['value']['contacts'][0] for i in range(size)]
+    return body
+
+
+def chained(raw):
+    body = json.loads(raw)
+    if body.get('object') == 'whatsapp_business_account':
+        if (
+            body.get('entry') and
+            body['entry'][0].get('changes') and
+            body['entry'][0]['changes'][0].get('value') and
+            body['entry'][0]['changes'][0]['value'].get('messages') and
+            body['entry'][0]['changes'][0]['value']['messages'][0]
+        ):
+            phone_number_id = body['entry'][0]['changes'][0]['value']['metadata']['phone_number_id']
+            from_number = body['entry'][0]['changes'][0]['value']['messages'][0]['from']
+            msg_body = body['entry'][0]['changes'][0]['value']['messages'][0]['text']['body']
+            return [(phone_number_id, from_number, msg_body)]
+    return []
+
+
+def dict_walk(raw):
+    body = json.loads(raw)
+    found = []
+    for entry in body.get('entry') or []:
+        for change in entry.get('changes') or []:
+            value = change.get('value') or {}
+            phone_number_id = (value.get('metadata') or {}).get('phone_number_id')
+            for message in value.get('messages') or []:
+                msg_body = (message.get('text') or {}).get('body')
+                if msg_body:
+                    found.append((phone_number_id, message['from'], msg_body))
+    return found
+
+
+def parsed(raw):
+    return [(m.phone_number_id, m.from_number, m.text) for m in payload.parse(raw).messages if m.text]
+
+
+def parsed_stdlib(raw):
+    saved, payload.orjson = payload.orjson, None
+    try:
+        return parsed(raw)
+    finally:
+        payload.orjson = saved
+
+
+def best_of(fn, raw, number):
+    return min(timeit.repeat(lambda: fn(raw), number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=1000, help='messages in the batched payload')
+    args = parser.parse_args()
+
+    cases = [
+        ('1 message', json.dumps(message_payload(1)).encode(), 20000),
+        ('1 status', json.dumps(status_payload(1)).encode(), 20000),
+        (f'{args.batch} messages', json.dumps(batch_payload(args.batch)).encode(), 20),
+    ]
+    methods = [('chained dict', chained), ('dict walk', dict_walk), ('parse (json)', parsed_stdlib)]
+    if payload.orjson is not None:
+        methods.append(('parse (orjson)', parsed))
+
+    print(f'{"payload":<16} {"bytes":>8} ' + ' '.join(f'{name + " us":>18}' for name, _ in methods))
+    for label, raw, number in cases:
+        results = ' '.join(f'{best_of(fn, raw, number) * 1e6:>18.1f}' for _, fn in methods)
+        print(f'{label:<16} {len(raw):>8} {results}')
+    print('chained dict only reads the first message of a batch.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Precision of the semantic cache's matches, and lookup latency as it fills up.
+
+    python benchmarks/bench_semantic_cache.py --sizes 10000,100000,1000000 --dim 256
+    python benchmarks/bench_semantic_cache.py --thresholds 0.85,0.9,0.95 --sizes 0
+
+The precision check scores pairs of questions that want different answers
+(NEAR_MISSES: one word or the word order changed) and pairs that want the
+same one (REWORDINGS), and counts how many of each would be answered from
+the cache at each --thresholds value. A near miss above the threshold is a
+wrong answer sent to a user.
+
+For latency, entries are random unit vectors written straight into the
+index (embedding a million questions one by one would dominate the run);
+lookups embed a real question, so the timings include embedding.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from semantic_cache import SemanticCache, embed, embed_batch  # noqa: E402
+
+QUESTIONS = [
+    'What are your opening hours on weekends?',
+    'how much does delivery cost to berlin',
+    'Can I return an item after 30 days?',
+    'do you have the blue jacket in size M',
+]
+
+NEAR_MISSES = [
+    ('opening hours on monday', 'opening hours on sunday'),
+    ('capital of austria', 'capital of australia'),
+    ('convert 100 usd to eur', 'convert 100 eur to usd'),
+    ('how much does delivery cost to berlin', 'how much does delivery cost to munich'),
+    ('can i return an item after 30 days', 'can i return an item after 60 days'),
+    ('do you have the blue jacket in size m', 'do you have the blue jacket in size l'),
+    ('is the store open today', 'is the store open tomorrow'),
+    ('how do i cancel my order', 'how do i change my order'),
+]
+
+REWORDINGS = [
+    ('What are your opening hours?', 'what are your opening hours'),
+    ('do you have the blue jacket in size m', 'do you have the blue jacket in size M please'),
+    ('how much does delivery cost to berlin', 'how much does delivery to berlin cost'),
+    ('what are your opening hours', 'what are the opening hours'),
+    ('how much does delivery cost to berlin', 'how much is delivery to berlin'),
+    ('what are your hours', 'when are you open'),
+]
+
+
+def precision(thresholds, dim):
+    def scores(pairs):
+        return [float(embed(a, dim) @ embed(b, dim)) for a, b in pairs]
+    near, same = scores(NEAR_MISSES), scores(REWORDINGS)
+    print(f'{"threshold":>9} {"wrong answers":>14} {"rewordings hit":>15}')
+    for threshold in thresholds:
+        wrong = sum(score >= threshold for score in near)
+        hit = sum(score >= threshold for score in same)
+        print(f'{threshold:>9.2f} {f"{wrong}/{len(near)}":>14} {f"{hit}/{len(same)}":>15}')
+    print(f'highest near miss {max(near):.3f}; rewordings ' + ' '.join(f'{score:.2f}' for score in same))
+
+
+def fill(cache, size, rng):
+    chunk = 100000
+    for start in range(0, size, chunk):
+        rows = min(chunk, size - start)
+        vectors = rng.standard_normal((rows, cache.dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        cache._vectors[start:start + rows] = vectors
+    cache._tenants[:size] = cache._tenant_code('bench')
+    cache._expires[:size] = time.monotonic() + 3600
+    cache._answers[:size] = ['answer'] * size
+    cache.size = size
+
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000, timings[int(len(timings) * 0.99)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--thresholds', default='0.85,0.9,0.95', help='SEMANTIC_CACHE_THRESHOLD values to check')
+    args = parser.parse_args()
+
+    precision([float(t) for t in args.thresholds.split(',')], args.dim)
+    sizes = [size for size in map(int, args.sizes.split(',')) if size > 0]
+    if not sizes:
+        return
+
+    rng = np.random.default_rng(0)
+    query = QUESTIONS[0]
+    batch = (QUESTIONS * args.batch)[:args.batch]
+    print(f'embed one question: {timed(lambda: embed_batch([query], args.dim), 1000)[0] * 1000:.1f} us')
+    print(f'{"entries":>9} {"MiB":>7} {"get p50":>9} {"get p99":>9} {f"batch{args.batch} p50":>11} {"per query":>10}')
+    for size in sizes:
+        cache = SemanticCache(max_entries=size, dim=args.dim)
+        fill(cache, size, rng)
+        p50, p99 = timed(lambda: cache.get('bench', query), args.repeat)
+        batch_p50, _ = timed(lambda: cache.get_batch('bench', batch), args.repeat)
+        print(
+            f'{size:>9} {cache._vectors.nbytes / 2**20:>7.0f} {p50:>7.2f}ms {p99:>7.2f}ms '
+            f'{batch_p50:>9.2f}ms {batch_p50 / args.batch:>8.3f}ms'
+        )
+        del cache
+
+
+if __name__ == '__main__':
+    main()
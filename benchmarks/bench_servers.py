@@ -0,0 +1,247 @@
+"""Side-by-side throughput of the ways to run the server, against local stubs.
+
+    python benchmarks/bench_servers.py --messages 2000 --concurrency 500 --llm-latency 1.0
+    python benchmarks/bench_servers.py --servers gunicorn,uvicorn --workers 4
+    python benchmarks/bench_servers.py --llm-latency lognormal:0.8,0.6 --tokens-per-second 50 \
+        --answer-words 120 --llm-fail-rate 0.02 --status-ratio 3
+
+Each server runs in its own subprocess with OPENAI_BASE_URL and GRAPH_API_URL
+pointing at the stubs, and is sent webhooks shaped like Meta's. A message
+counts as done when its first reply reaches the Graph stub, so servers that
+acknowledge early are not flattered. Errors are non-200 acknowledgements
+plus messages that got no reply before --timeout.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from stubs import graph_stub, openai_stub
+
+APP_SECRET = 'bench'
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SERVERS = {
+    # Werkzeug's threaded development server, as app.run() used to start it.
+    'flask': [sys.executable, '-c', 'import server; server.app.run(port={port}, threaded=True)'],
+    'flask-bg': [sys.executable, '-c', 'import server; server.app.run(port={port}, threaded=True)'],
+    # flask-bg with every message written to a SQLite inbox before the ack.
+    'flask-inbox': [sys.executable, '-c', 'import server; server.app.run(port={port}, threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', '{port}', '--log-level', 'warning'],
+    'gunicorn': [sys.executable, 'run.py', '--server', 'gunicorn', '--bind', '127.0.0.1:{port}'],
+    'uvicorn': [sys.executable, 'run.py', '--server', 'uvicorn', '--bind', '127.0.0.1:{port}'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def sender(i):
+    return f'1555{i:07d}'
+
+
+def payload(i):
+    """A text message webhook shaped like the ones Meta sends."""
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "102290129340398",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "metadata": {"display_phone_number": "15550783881", "phone_number_id": "1234"},
+                    "contacts": [{"profile": {"name": f"Bench User {i}"}, "wa_id": sender(i)}],
+                    "messages": [{
+                        "from": sender(i),
+                        "id": f"wamid.HBgLMTU1NTAxMjM0NTYVAgASGBQzQUJFTkNI{i:012d}",
+                        "timestamp": str(int(time.time())),
+                        "type": "text",
+                        "text": {"body": f"Question {i}: how do I reset my password on the app?"},
+                    }],
+                },
+            }],
+        }],
+    }
+
+
+def status_payload(i):
+    """A delivery receipt, which needs no reply."""
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "102290129340398",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "metadata": {"display_phone_number": "15550783881", "phone_number_id": "1234"},
+                    "statuses": [{
+                        "id": f"wamid.HBgLMTU1NTAxMjM0NTYVAgARGBJTVEFUVVM{i:012d}",
+                        "status": "delivered",
+                        "timestamp": str(int(time.time())),
+                        "recipient_id": sender(i),
+                        "conversation": {"id": f"conv{i}", "origin": {"type": "service"}},
+                        "pricing": {"billable": True, "pricing_model": "CBP", "category": "service"},
+                    }],
+                },
+            }],
+        }],
+    }
+
+
+def signed(body):
+    """Raw body and headers, signed the way Meta signs webhooks."""
+    raw = json.dumps(body).encode()
+    digest = hmac.new(APP_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    return raw, {'Content-Type': 'application/json', 'X-Hub-Signature-256': 'sha256=' + digest}
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+
+def start_server(name, port, env):
+    command = [part.format(port=port) for part in SERVERS[name]]
+    proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # run.py execs the real server, so proc is the server process itself.
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/', timeout=1)
+            return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f'{name} did not start')
+
+
+async def drive(url, messages, concurrency, status_ratio):
+    """Post messages (and status_ratio status callbacks per message)."""
+    acks = []
+    sent = {}
+    errors = 0
+    limit = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        async def post(body, to):
+            nonlocal errors
+            raw, headers = signed(body)
+            async with limit:
+                start = time.perf_counter()
+                if to is not None:
+                    sent[to] = start
+                try:
+                    response = await client.post(url, content=raw, headers=headers)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                acks.append(time.perf_counter() - start)
+                if not ok:
+                    errors += 1
+                    sent.pop(to, None)
+
+        # Status callbacks are interleaved with messages, as Meta sends them.
+        posts = []
+        owed = 0.0
+        for i in range(messages):
+            posts.append(post(payload(i), sender(i)))
+            owed += status_ratio
+            while owed >= 1:
+                posts.append(post(status_payload(len(posts)), None))
+                owed -= 1
+        await asyncio.gather(*posts)
+    return sorted(acks), sent, errors
+
+
+def run(name, args, llm, graph):
+    port = free_port()
+    env = dict(
+        os.environ,
+        VERIFY_TOKEN='bench', WHATSAPP_TOKEN='bench', OPENAI_API_KEY='bench',
+        OPENAI_BASE_URL=llm.url + '/v1', GRAPH_API_URL=graph.url + '/v18.0',
+        GRAPH_POOL_SIZE=str(args.concurrency), DEDUPE_BACKEND='none', LOG_SINK='none',
+        SENDER_RATE_PER_MINUTE='0', RESPONSE_CACHE_SIZE='0', APP_SECRET=APP_SECRET,
+        GRAPH_NUMBER_RATE_PER_SECOND='0', GRAPH_RECIPIENT_RATE_PER_MINUTE='0',
+    )
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    if name == 'flask-bg':
+        env['BACKGROUND_WORKERS'] = str(args.concurrency)
+        env['BACKGROUND_QUEUE_SIZE'] = str(args.messages)
+    if name == 'flask-inbox':
+        directory = tempfile.mkdtemp()
+        env['INBOX_PATH'] = os.path.join(directory, 'inbox.sqlite3')
+        env['INBOX_WORKERS'] = str(args.concurrency)
+    proc = start_server(name, port, env)
+    try:
+        llm.reset_counts()
+        graph.reset_counts()
+        start = time.perf_counter()
+        acks, sent, errors = asyncio.run(
+            drive(f'http://127.0.0.1:{port}/webhook', args.messages, args.concurrency, args.status_ratio)
+        )
+        deadline = time.perf_counter() + args.timeout
+        while any(to not in graph.deliveries for to in sent) and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+        if name == 'flask-inbox':
+            shutil.rmtree(directory)
+    replies = sorted(graph.deliveries[to][0] - started for to, started in sent.items() if to in graph.deliveries)
+    failed = errors + len(sent) - len(replies)
+    print(
+        f'{name:<11} {len(replies) / elapsed:>10.1f} '
+        + ' '.join(f'{percentile(acks, q) * 1000:>8.1f}' for q in (0.5, 0.95, 0.99)) + ' '
+        + ' '.join(f'{percentile(replies, q) * 1000:>8.0f}' for q in (0.5, 0.95, 0.99))
+        + f' {failed / len(acks):>7.1%} {llm.peak_active:>9}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--llm-latency', default='1.0',
+                        help='seconds, or a distribution such as lognormal:1.0,0.5 (see stubs.distribution)')
+    parser.add_argument('--tokens-per-second', type=float, default=0, help='OpenAI stub output rate; 0 is instant')
+    parser.add_argument('--answer-words', type=int, default=0, help='length of stub answers; 0 echoes the question')
+    parser.add_argument('--llm-fail-rate', type=float, default=0, help='share of OpenAI stub requests answered 500')
+    parser.add_argument('--graph-latency', default='0')
+    parser.add_argument('--status-ratio', type=float, default=0, help='status callbacks posted per message')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for outstanding replies')
+    parser.add_argument('--servers', default='flask,flask-bg,asgi')
+    parser.add_argument('--workers', type=int, help='WEB_CONCURRENCY for gunicorn and uvicorn')
+    args = parser.parse_args()
+
+    llm = openai_stub(
+        args.llm_latency, tokens_per_second=args.tokens_per_second, answer_words=args.answer_words,
+        fail_rate=args.llm_fail_rate,
+    )
+    with llm, graph_stub(args.graph_latency) as graph:
+        print(f'{"":<11} {"":>10} {"webhook ack ms":^26} {"first reply ms":^26}')
+        print(
+            f'{"server":<11} {"replies/s":>10} {"p50":>8} {"p95":>8} {"p99":>8} '
+            f'{"p50":>8} {"p95":>8} {"p99":>8} {"errors":>7} {"peak llm":>9}'
+        )
+        for name in args.servers.split(','):
+            run(name, args, llm, graph)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Cost of X-Hub-Signature-256 verification per request size.
+
+    python benchmarks/bench_signature.py --sizes 1000,10000,100000,1000000
+
+For webhook bodies of each size, times verifying a genuine signature,
+rejecting a forged one, and decoding the body with payload.parse(), the
+work a forged request would otherwise cause. Then posts genuine and forged
+webhooks to the Flask app's test client to compare whole-request costs.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+os.environ['APP_SECRET'] = 'bench-secret'
+os.environ['LOG_SINK'] = 'none'
+
+from bench_parser import batch_payload  # noqa: E402
+
+import payload  # noqa: E402
+import server  # noqa: E402
+import signature  # noqa: E402
+
+SECRET = b'bench-secret'
+
+
+def body_of_size(size):
+    # A batch of status-free text messages grown until it reaches size bytes.
+    messages = 1
+    while len(json.dumps(batch_payload(messages))) < size:
+        messages *= 2
+    return json.dumps(batch_payload(messages)).encode()
+
+
+def best_of(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000')
+    args = parser.parse_args()
+
+    verifier = signature.Verifier([SECRET])
+    forged = 'sha256=' + '0' * 64
+    print(f'{"bytes":>9} {"verify us":>10} {"reject us":>10} {"parse us":>10} {"verify/parse":>13}')
+    for size in (int(s) for s in args.sizes.split(',')):
+        raw = body_of_size(size)
+        header = signature.sign(raw, SECRET)
+        number = max(5, 2000000 // len(raw))
+        verify = best_of(lambda: verifier.check(raw, header), number)
+        reject = best_of(lambda: verifier.check(raw, forged), number)
+        parse = best_of(lambda: payload.parse(raw), number)
+        print(f'{len(raw):>9} {verify * 1e6:>10.1f} {reject * 1e6:>10.1f} {parse * 1e6:>10.1f} {verify / parse:>13.1%}')
+
+    # Whole requests through Flask, for a one-message webhook whose replies
+    # are never sent (the message is a duplicate after the first post).
+    client = server.app.test_client()
+    raw = json.dumps(batch_payload(1)).encode()
+    headers = {'Content-Type': 'application/json', signature.HEADER: signature.sign(raw, SECRET)}
+    server.dedupe.is_duplicate(server.dedupe_store, payload.parse(raw).messages[0].id)
+    genuine = best_of(lambda: client.post('/webhook', data=raw, headers=headers), 500)
+    headers[signature.HEADER] = forged
+    rejected = best_of(lambda: client.post('/webhook', data=raw, headers=headers), 500)
+    print(f'Flask request, {len(raw)} bytes: accepted {genuine * 1e6:.0f} us, forged rejected {rejected * 1e6:.0f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Split and send very long answers.
+
+    python benchmarks/bench_splitter.py --sizes 10000,100000,1000000
+
+For each answer size, times split_message() alone and then the full
+send_reply() path (split plus one Graph call per part) against the local
+Graph stub over the pooled session.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+
+from stubs import graph_stub  # noqa: E402
+
+import graph  # noqa: E402
+import server  # noqa: E402
+from splitter import split_message  # noqa: E402
+
+# All parts go to one recipient, which pacing would hold to one every 6s.
+graph.pacer = None
+
+PARAGRAPH = ' '.join(
+    f'Sentence {i} explains another part of the answer in a reasonable amount of detail.' for i in range(8)
+)
+CODE = '```python\n' + '\n'.join(f'result_{i} = compute(values[{i}], scale={i})' for i in range(60)) + '\n```'
+
+
+def answer(size):
+    blocks, length = [], 0
+    while length < size:
+        block = CODE if len(blocks) % 5 == 4 else PARAGRAPH
+        blocks.append(block)
+        length += len(block) + 2
+    return '\n\n'.join(blocks)[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    args = parser.parse_args()
+
+    with graph_stub() as stub:
+        graph.GRAPH_API_URL = stub.url + '/v18.0'
+        print(f'{"chars":>9} {"parts":>6} {"split ms":>9} {"send ms":>9} {"ms/part":>8} {"conns":>6}')
+        for size in map(int, args.sizes.split(',')):
+            text = answer(size)
+            start = time.perf_counter()
+            parts = split_message(text)
+            split_ms = (time.perf_counter() - start) * 1000
+            assert all(len(part) <= 4096 for part in parts)
+            stub.reset_counts()
+            start = time.perf_counter()
+            server.send_reply('1234', '15550001111', text)
+            send_ms = (time.perf_counter() - start) * 1000
+            assert stub.requests == len(parts) or len(server.reply_text(text)) != len(text)
+            print(
+                f'{size:>9} {stub.requests:>6} {split_ms:>9.2f} {send_ms:>9.1f} '
+                f'{send_ms / stub.requests:>8.2f} {stub.connections:>6}'
+            )
+
+
+if __name__ == '__main__':
+    main()
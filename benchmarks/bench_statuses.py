@@ -0,0 +1,60 @@
+"""Cost of a status callback with and without the fast path.
+
+    python benchmarks/bench_statuses.py --requests 5000
+
+Times statuses.is_status_only() against payload.parse() on a delivery
+receipt, then posts receipts to the Flask app's test client with
+STATUS_CALLBACKS set to full (parsed and logged like any webhook), ack and
+aggregate. For the effect on message latency under a mixed load, run
+bench_servers.py --status-ratio 5 with STATUS_CALLBACKS=full and without.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('OPENAI_API_KEY', 'bench')
+os.environ.pop('APP_SECRET', None)
+
+from bench_servers import status_payload  # noqa: E402
+
+import eventlog  # noqa: E402
+import payload  # noqa: E402
+import server  # noqa: E402
+import statuses  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    raw = json.dumps(status_payload(1)).encode()
+    classify = min(timeit.repeat(lambda: statuses.is_status_only(raw), number=20000, repeat=5)) / 20000
+    parse = min(timeit.repeat(lambda: payload.parse(raw), number=20000, repeat=5)) / 20000
+    print(f'{len(raw)} byte receipt: is_status_only {classify * 1e6:.2f} us, payload.parse {parse * 1e6:.2f} us')
+
+    # Log to memory so the full path pays for logging without flooding the terminal.
+    server.events = eventlog.EventLog(io.StringIO())
+    client = server.app.test_client()
+    headers = {'Content-Type': 'application/json'}
+    modes = [
+        ('full', False, None),
+        ('ack', True, None),
+        ('aggregate', True, statuses.StatusAggregator(events=server.events)),
+    ]
+    for name, fast_path, aggregator in modes:
+        server.STATUS_FAST_PATH, server.status_aggregator = fast_path, aggregator
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            client.post('/webhook', data=raw, headers=headers)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<10} {args.requests / elapsed:>8.0f} receipts/s {elapsed / args.requests * 1e6:>8.0f} us each')
+
+
+if __name__ == '__main__':
+    main()
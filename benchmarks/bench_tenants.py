@@ -0,0 +1,119 @@
+"""A noisy tenant's flood and a quiet tenant's latency, with and without bulkheads.
+
+    python benchmarks/bench_tenants.py --flood 400 --workers 16
+
+Two business numbers share one server in this process. The noisy one sends
+--flood messages at once while the quiet one sends a message every 100 ms.
+With a shared pool every message waits in one BACKGROUND_WORKERS queue; with
+bulkheads TENANTS_FILE gives the quiet tenant --quiet-workers of the same
+total and the noisy tenant the rest. The report shows time to first reply
+for each tenant and how many of the flood's webhooks were refused.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_servers import payload, percentile, sender  # noqa: E402
+from stubs import graph_stub, openai_stub  # noqa: E402
+
+NOISY, QUIET = '1111', '2222'
+
+
+def webhook(phone_number_id, i):
+    body = payload(i)
+    body['entry'][0]['changes'][0]['value']['metadata']['phone_number_id'] = phone_number_id
+    return json.dumps(body)
+
+
+def run(label, server, whatsapp, args):
+    client = server.app.test_client()
+    whatsapp.reset_counts()
+    sent = {NOISY: {}, QUIET: {}}
+    refused = []
+
+    def post(phone_number_id, i):
+        started = time.perf_counter()
+        status = client.post('/webhook', data=webhook(phone_number_id, i), content_type='application/json').status_code
+        if status == 200:
+            sent[phone_number_id][sender(i)] = started
+        else:
+            refused.append(phone_number_id)
+
+    def quiet():
+        for i in range(args.quiet):
+            post(QUIET, 1000000 + i)
+            time.sleep(0.1)
+
+    offset = len(label) * 100000
+    thread = threading.Thread(target=quiet)
+    thread.start()
+    for i in range(args.flood):
+        post(NOISY, offset + i)
+    thread.join()
+    deadline = time.perf_counter() + args.timeout
+    expected = [to for numbers in sent.values() for to in numbers]
+    while any(to not in whatsapp.deliveries for to in expected) and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    for phone_number_id, name in ((NOISY, 'noisy'), (QUIET, 'quiet')):
+        replies = sorted(whatsapp.deliveries[to][0] - started
+                         for to, started in sent[phone_number_id].items() if to in whatsapp.deliveries)
+        print(
+            f'{label:<10} {name:<6} {len(replies):>8} {refused.count(phone_number_id):>8} '
+            + ' '.join(f'{percentile(replies, q) * 1000:>8.0f}' for q in (0.5, 0.95, 0.99))
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flood', type=int, default=400)
+    parser.add_argument('--quiet', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=16, help='worker threads in total')
+    parser.add_argument('--quiet-workers', type=int, default=4)
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    openai = openai_stub(args.llm_latency).start()
+    whatsapp = graph_stub().start()
+    os.environ.update({
+        'OPENAI_API_KEY': 'stub', 'OPENAI_BASE_URL': openai.url + '/v1',
+        'WHATSAPP_TOKEN': 'stub', 'GRAPH_API_URL': whatsapp.url + '/v18.0',
+        'BACKGROUND_WORKERS': str(args.workers), 'BACKGROUND_QUEUE_SIZE': str(args.flood + args.quiet),
+        'SENDER_RATE_PER_MINUTE': '0', 'RESPONSE_CACHE_SIZE': '0',
+        'GRAPH_NUMBER_RATE_PER_SECOND': '0', 'GRAPH_RECIPIENT_RATE_PER_MINUTE': '0',
+        'DEDUPE_BACKEND': 'none', 'LOG_SINK': 'none',
+    })
+    import server
+    import tenancy
+
+    def load(config):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(config, f)
+        os.environ['TENANTS_FILE'] = f.name
+        try:
+            return tenancy.load(server.default_tenant, None)
+        finally:
+            os.unlink(f.name)
+
+    modes = [
+        ('shared', {NOISY: {'name': 'noisy'}, QUIET: {'name': 'quiet'}}),
+        ('bulkheads', {
+            NOISY: {'name': 'noisy', 'workers': args.workers - args.quiet_workers, 'queue_size': args.flood},
+            QUIET: {'name': 'quiet', 'workers': args.quiet_workers, 'queue_size': args.quiet},
+        }),
+    ]
+    print(f'{"":<17} {"":>8} {"":>8} {"first reply ms":^26}')
+    print(f'{"pools":<10} {"tenant":<6} {"replies":>8} {"refused":>8} {"p50":>8} {"p95":>8} {"p99":>8}')
+    for label, config in modes:
+        server.tenants = load(config)
+        run(label, server, whatsapp, args)
+
+
+if __name__ == '__main__':
+    main()
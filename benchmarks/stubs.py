@@ -0,0 +1,346 @@
+"""Local stand-ins for the external APIs the server talks to.
+
+Each stub is a small HTTP/1.1 keep-alive server bound to an ephemeral port
+on 127.0.0.1. It runs on its own asyncio loop in a background thread, so
+thousands of slow responses can be outstanding at once without a thread
+per connection, and it counts the TCP connections and requests it receives.
+
+Every stub can also inject faults, set as options at construction or changed
+on stub.options while it runs:
+
+    fail_rate     share of requests answered with fail_status instead
+    fail_status   status of injected failures (default 500)
+    retry_after   Retry-After header sent with injected failures
+    stall_rate    share of requests that wait stall seconds first, to
+                  trigger client read timeouts
+
+The Graph stub can also enforce Meta's send limits, refusing sends over
+them with the error codes Meta uses and counting them in stub.violations:
+
+    number_rate, number_burst   sends a second per phone_number_id (130429)
+    pair_rate, pair_burst       sends a second per recipient (131056)
+
+latency is a number of seconds or a distribution spec (see distribution()),
+sampled for every request.
+"""
+import asyncio
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+
+class Request:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+
+def distribution(spec):
+    """Sampler of delays in seconds for a latency spec.
+
+    A number (or 'fixed:S'), 'uniform:LOW,HIGH', 'normal:MEAN,STDDEV',
+    'lognormal:MEDIAN,SIGMA' or 'exponential:MEAN'. Negative draws become 0.
+    """
+    if callable(spec):
+        return spec
+    if isinstance(spec, (int, float)):
+        return lambda: spec
+    kind, _, params = spec.partition(':')
+    if not params:
+        kind, params = 'fixed', kind
+    first, _, second = params.partition(',')
+    a = float(first)
+    b = float(second) if second else None
+    samplers = {
+        'fixed': lambda: a,
+        'uniform': lambda: random.uniform(a, b),
+        'normal': lambda: max(0.0, random.gauss(a, b)),
+        'lognormal': lambda: a * math.exp(random.gauss(0, b)),
+        'exponential': lambda: random.expovariate(1 / a),
+    }
+    if kind not in samplers:
+        raise ValueError(f'unknown latency distribution {spec!r}')
+    return samplers[kind]
+
+
+def json_response(status, payload, headers=None):
+    return status, dict(headers or {}, **{'Content-Type': 'application/json'}), json.dumps(payload).encode()
+
+
+class StubServer:
+    def __init__(self, handler, latency=0.0, **options):
+        self.handler = handler
+        self.latency = latency
+        self._delay = distribution(latency)
+        self.options = options
+        self.connections = 0
+        self.requests = 0
+        self.active = 0
+        self.peak_active = 0
+        self.faults = 0
+        self.violations = 0
+        # Token buckets for the Graph stub's send limits: key -> [tokens, time].
+        self.buckets = {}
+        # perf_counter() times at which each recipient was sent a message.
+        self.deliveries = {}
+        self.port = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._connections = set()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    def reset_counts(self):
+        self.connections = 0
+        self.requests = 0
+        self.peak_active = 0
+        self.faults = 0
+        self.violations = 0
+        self.buckets = {}
+        self.deliveries = {}
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(ready,), daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _serve(self, ready):
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, '127.0.0.1', 0, backlog=4096)
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _close(self):
+        self._server.close()
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                self.requests += 1
+                self.active += 1
+                self.peak_active = max(self.peak_active, self.active)
+                try:
+                    status, headers, body = await self._fault() or await self.handler(self, request)
+                finally:
+                    self.active -= 1
+                await self._write_response(writer, status, headers, body)
+                if request.headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Cancelled only by stop(), which waits for these tasks to end.
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def pause(self):
+        """Sleep for one draw from the latency distribution."""
+        delay = self._delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _fault(self):
+        """An injected error response, or None to let the handler answer."""
+        if random.random() < self.options.get('stall_rate', 0):
+            await asyncio.sleep(self.options.get('stall', 30))
+        if random.random() >= self.options.get('fail_rate', 0):
+            return None
+        self.faults += 1
+        headers = {}
+        if self.options.get('retry_after') is not None:
+            headers['Retry-After'] = str(self.options['retry_after'])
+        return json_response(self.options.get('fail_status', 500), {
+            "error": {"message": "injected fault", "type": "stub_error", "code": None},
+        }, headers)
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        body = await reader.readexactly(length) if length else b''
+        return Request(method, target, headers, body)
+
+    async def _write_response(self, writer, status, headers, body):
+        head = [f'HTTP/1.1 {status} Stub']
+        head += [f'{name}: {value}' for name, value in headers.items()]
+        if isinstance(body, bytes):
+            head.append(f'Content-Length: {len(body)}')
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+            await writer.drain()
+            return
+        # Anything else is an async iterator of chunks, sent as they come.
+        head.append('Transfer-Encoding: chunked')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode())
+        async for chunk in body:
+            writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+def _take(stub, key, rate, burst):
+    now = time.monotonic()
+    bucket = stub.buckets.setdefault(key, [burst, now])
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] < 1:
+        return False
+    bucket[0] -= 1
+    return True
+
+
+def _over_limit(stub, phone_number_id, to):
+    """The Graph error code for a send over the stub's limits, or None."""
+    options = stub.options
+    if options.get('number_rate') and not _take(
+        stub, phone_number_id, options['number_rate'], options.get('number_burst', options['number_rate']),
+    ):
+        return 130429
+    if options.get('pair_rate') and not _take(
+        stub, (phone_number_id, to), options['pair_rate'], options.get('pair_burst', 1),
+    ):
+        return 131056
+    return None
+
+
+async def graph_handler(stub, request):
+    """Accepts POST /<version>/<phone_number_id>/messages like the Graph API."""
+    to = (request.json() or {}).get('to')
+    code = _over_limit(stub, request.path.split('/')[2], to)
+    if code is not None:
+        stub.violations += 1
+        return json_response(400, {
+            "error": {"message": f"(#{code}) Rate limit hit", "type": "OAuthException", "code": code},
+        })
+    stub.deliveries.setdefault(to, []).append(time.perf_counter())
+    await stub.pause()
+    return json_response(200, {
+        "messaging_product": "whatsapp",
+        "messages": [{"id": f"wamid.stub{stub.requests}"}],
+    })
+
+
+def graph_stub(latency=0.0, **options):
+    return StubServer(graph_handler, latency, **options)
+
+
+def completion_payload(content, prompt_tokens=20, completion_tokens=None):
+    completion_tokens = completion_tokens or max(1, len(content) // 4)
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "gpt-3.5-turbo",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _stream_chunk(delta, finish_reason=None):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "gpt-3.5-turbo",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+async def _sse(content, tokens_per_second, include_usage=False):
+    # Roughly one token per word; the first event carries the role.
+    yield b'data: ' + json.dumps(_stream_chunk({"role": "assistant", "content": ""})).encode() + b'\n\n'
+    for token in re.findall(r'\S+\s*', content):
+        if tokens_per_second:
+            await asyncio.sleep(1 / tokens_per_second)
+        yield b'data: ' + json.dumps(_stream_chunk({"content": token})).encode() + b'\n\n'
+    yield b'data: ' + json.dumps(_stream_chunk({}, 'stop')).encode() + b'\n\n'
+    if include_usage:
+        chunk = dict(_stream_chunk({}), choices=[], usage=completion_payload(content)['usage'])
+        yield b'data: ' + json.dumps(chunk).encode() + b'\n\n'
+    yield b'data: [DONE]\n\n'
+
+
+async def openai_handler(stub, request):
+    """Answers POST /v1/chat/completions by echoing the last user message.
+
+    Options: answer (fixed reply text), answer_words (reply length, repeating
+    the answer's words) and tokens_per_second (pacing of the reply; streamed
+    replies arrive token by token). latency is the delay before the first token.
+    """
+    payload = request.json() or {}
+    await stub.pause()
+    question = payload.get('messages', [{}])[-1].get('content', '')
+    content = stub.options.get('answer') or f'Stub answer to: {question}'
+    if stub.options.get('answer_words'):
+        content = ' '.join(itertools.islice(itertools.cycle(content.split()), stub.options['answer_words']))
+    tokens_per_second = stub.options.get('tokens_per_second')
+    if payload.get('stream'):
+        include_usage = (payload.get('stream_options') or {}).get('include_usage', False)
+        return 200, {'Content-Type': 'text/event-stream'}, _sse(content, tokens_per_second, include_usage)
+    if tokens_per_second:
+        await asyncio.sleep(len(re.findall(r'\S+\s*', content)) / tokens_per_second)
+    return json_response(200, completion_payload(content))
+
+
+def openai_stub(latency=0.0, **options):
+    return StubServer(openai_handler, latency, **options)
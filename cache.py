@@ -0,0 +1,63 @@
+import os
+import re
+import string
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+_PUNCTUATION = str.maketrans('', '', string.punctuation + '¿¡“”‘’…')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize(query):
+    """Fold case, punctuation and whitespace so trivially different questions match."""
+    return _WHITESPACE.sub(' ', query.casefold().translate(_PUNCTUATION)).strip()
+
+
+class ResponseCache:
+    """LRU cache of answers whose entries also expire after a TTL."""
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+                metrics.inc('response_cache_expirations')
+                entry = None
+            if entry is None:
+                metrics.inc('response_cache_misses')
+                return None
+            self._entries.move_to_end(key)
+        metrics.inc('response_cache_hits')
+        return entry[0]
+
+    def put(self, key, answer):
+        with self._lock:
+            self._entries[key] = (answer, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                metrics.inc('response_cache_evictions')
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def create_cache():
+    max_size = int(os.getenv('RESPONSE_CACHE_SIZE', '10000'))
+    if max_size <= 0:
+        return None
+    return ResponseCache(max_size, float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '3600')))
+
+
+def disabled_tenants():
+    return {tenant.strip() for tenant in os.getenv('RESPONSE_CACHE_DISABLED_FOR', '').split(',') if tenant.strip()}
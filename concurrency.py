@@ -0,0 +1,136 @@
+"""Adaptive (AIMD) concurrency limit for calls to a slow dependency.
+
+The limit grows by about one slot per round trip while calls finish within
+the latency target and the limit is actually in use, and is cut by a factor
+on a timeout, a 429, or a slow call. Callers over the limit wait for a slot
+up to queue_timeout and are then rejected with Overloaded.
+"""
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+
+
+class Overloaded(Exception):
+    """No slot became free within the queue timeout."""
+
+
+class _AIMD:
+    def __init__(self, name, initial=32, min_limit=2, max_limit=512, latency_target=20.0,
+                 backoff=0.5, queue_timeout=30.0, overload_errors=()):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.queue_timeout = queue_timeout
+        self.overload_errors = overload_errors
+        self.in_flight = 0
+        # Calls that were already in flight when the limit was cut report
+        # their failures shortly after; one cut per window is enough.
+        self._cooldown = latency_target
+        self._last_decrease = -float('inf')
+        metrics.set_gauge(f'{name}_concurrency_limit', int(self.limit))
+
+    def _free(self):
+        return self.in_flight < int(self.limit)
+
+    def _reject(self):
+        metrics.inc(f'{self.name}_limiter_rejected')
+        return Overloaded(f'{self.name}: no slot free after {self.queue_timeout:g}s (limit {int(self.limit)})')
+
+    def _acquired(self, waited):
+        self.in_flight += 1
+        metrics.observe(f'{self.name}_queue_wait_seconds', waited)
+
+    def _released(self, latency, overloaded):
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        now = time.monotonic()
+        if overloaded or latency > self.latency_target:
+            metrics.inc(f'{self.name}_limiter_backoffs')
+            if now - self._last_decrease >= self._cooldown:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease = now
+        elif saturated:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        metrics.set_gauge(f'{self.name}_concurrency_limit', int(self.limit))
+
+
+class AdaptiveLimiter(_AIMD):
+    """Thread-safe limiter: ``with limiter.slot(): call()``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        started = time.monotonic()
+        with self._cond:
+            while not self._free():
+                remaining = self.queue_timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    raise self._reject()
+                self._cond.wait(remaining)
+            self._acquired(time.monotonic() - started)
+        began = time.monotonic()
+        overloaded = False
+        try:
+            yield
+        except self.overload_errors:
+            overloaded = True
+            raise
+        finally:
+            with self._cond:
+                self._released(time.monotonic() - began, overloaded)
+                self._cond.notify_all()
+
+
+class AsyncAdaptiveLimiter(_AIMD):
+    """Event-loop limiter: ``async with limiter.slot(): await call()``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        started = time.monotonic()
+        async with self._cond:
+            try:
+                await asyncio.wait_for(self._cond.wait_for(self._free), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._reject() from None
+            self._acquired(time.monotonic() - started)
+        began = time.monotonic()
+        overloaded = False
+        try:
+            yield
+        except self.overload_errors:
+            overloaded = True
+            raise
+        finally:
+            async with self._cond:
+                self._released(time.monotonic() - began, overloaded)
+                self._cond.notify_all()
+
+
+def from_env(limiter_class, name, overload_errors=(), max_limit=None):
+    """Build a limiter from ADAPTIVE_CONCURRENCY* variables, or None if disabled."""
+    if os.getenv('ADAPTIVE_CONCURRENCY', 'false').lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    return limiter_class(
+        name,
+        initial=int(os.getenv('ADAPTIVE_CONCURRENCY_INITIAL', '32')),
+        min_limit=int(os.getenv('ADAPTIVE_CONCURRENCY_MIN', '2')),
+        max_limit=max_limit or int(os.getenv('ADAPTIVE_CONCURRENCY_MAX', '512')),
+        latency_target=float(os.getenv('ADAPTIVE_CONCURRENCY_LATENCY_TARGET', '20')),
+        backoff=float(os.getenv('ADAPTIVE_CONCURRENCY_BACKOFF', '0.5')),
+        queue_timeout=float(os.getenv('ADAPTIVE_CONCURRENCY_QUEUE_TIMEOUT', '30')),
+        overload_errors=overload_errors,
+    )
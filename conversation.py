@@ -0,0 +1,201 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Every chat message costs a few tokens of framing on top of its content.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Token count for one chat message; exact with tiktoken, estimated without."""
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            # The encoding is fetched on first use; without network fall back
+            # to the ~4 characters per token estimate for good.
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text)) + MESSAGE_OVERHEAD_TOKENS
+    return len(text) // 4 + 1 + MESSAGE_OVERHEAD_TOKENS
+
+
+class Conversation:
+    """Recent turns of one chat, kept within a token budget."""
+
+    __slots__ = ('turns', 'tokens', 'last_seen')
+
+    def __init__(self, max_turns):
+        # Each turn is (role, content, tokens); tokens are counted once on
+        # append so trimming never re-tokenizes.
+        self.turns = deque(maxlen=max_turns)
+        self.tokens = 0
+        self.last_seen = time.monotonic()
+
+    def append(self, role, content, token_budget):
+        if len(self.turns) == self.turns.maxlen:
+            self.tokens -= self.turns[0][2]
+        tokens = count_tokens(content)
+        self.turns.append((role, content, tokens))
+        self.tokens += tokens
+        while self.turns and (self.tokens > token_budget or self.turns[0][0] == 'assistant'):
+            # Never start the history with an answer whose question was trimmed.
+            self.tokens -= self.turns.popleft()[2]
+        self.last_seen = time.monotonic()
+
+    def messages(self):
+        return [{"role": role, "content": content} for role, content, _ in self.turns]
+
+
+class ConversationStore:
+    """Per-sender conversations, bounded in senders, turns, tokens and idle time."""
+
+    def __init__(self, token_budget=1000, max_turns=20, max_senders=10000, idle_ttl=3600):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.max_senders = max_senders
+        self.idle_ttl = idle_ttl
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def history(self, key):
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                return []
+            if time.monotonic() - conversation.last_seen > self.idle_ttl:
+                del self._conversations[key]
+                return []
+            return conversation.messages()
+
+    def append(self, key, role, content):
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = Conversation(self.max_turns)
+                if len(self._conversations) > self.max_senders:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(key)
+            conversation.append(role, content, self.token_budget)
+
+    def record_exchange(self, key, question, answer):
+        self.append(key, 'user', question)
+        self.append(key, 'assistant', answer)
+
+    def __len__(self):
+        return len(self._conversations)
+
+
+class SQLiteConversationStore:
+    """Conversations shared by every process that opens the same database file,
+    so a follow-up keeps its context whichever worker receives it."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, token_budget=1000, max_turns=20, max_senders=10000, idle_ttl=3600):
+        self.path = path
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.max_senders = max_senders
+        self.idle_ttl = idle_ttl
+        self._local = threading.local()
+        self._writes = 0
+        # Use a throwaway connection so nothing is inherited across fork().
+        conn = sqlite3.connect(path, timeout=30)
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversations '
+                '(key TEXT PRIMARY KEY, turns TEXT NOT NULL, last_seen REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS conversations_last_seen ON conversations (last_seen)')
+        conn.close()
+
+    def history(self, key):
+        return [{"role": role, "content": content} for role, content, _ in self._turns(self._conn(), key, time.time())]
+
+    def append(self, key, role, content):
+        self._update(key, ((role, content),))
+
+    def record_exchange(self, key, question, answer):
+        self._update(key, (('user', question), ('assistant', answer)))
+
+    def _update(self, key, turns):
+        now = time.time()
+        conversation = Conversation(self.max_turns)
+        conn = self._conn()
+        # BEGIN IMMEDIATE so two processes cannot both read the old turns
+        # and one overwrite the other's.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conversation.turns.extend(tuple(turn) for turn in self._turns(conn, key, now))
+            conversation.tokens = sum(turn[2] for turn in conversation.turns)
+            for role, content in turns:
+                conversation.append(role, content, self.token_budget)
+            conn.execute(
+                'INSERT OR REPLACE INTO conversations (key, turns, last_seen) VALUES (?, ?, ?)',
+                (json.dumps(key), json.dumps(list(conversation.turns)), now),
+            )
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._purge(now)
+
+    def _turns(self, conn, key, now):
+        """(role, content, tokens) of key's conversation unless it has been idle too long."""
+        row = conn.execute(
+            'SELECT turns FROM conversations WHERE key = ? AND last_seen > ?', (json.dumps(key), now - self.idle_ttl),
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else []
+
+    def _purge(self, now):
+        conn = self._conn()
+        conn.execute('DELETE FROM conversations WHERE last_seen <= ?', (now - self.idle_ttl,))
+        conn.execute(
+            'DELETE FROM conversations WHERE key IN '
+            '(SELECT key FROM conversations ORDER BY last_seen DESC LIMIT -1 OFFSET ?)', (self.max_senders,),
+        )
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+
+def create_store():
+    token_budget = int(os.getenv('CONVERSATION_TOKEN_BUDGET', '1000'))
+    if token_budget <= 0:
+        return None
+    settings = dict(
+        token_budget=token_budget,
+        max_turns=int(os.getenv('CONVERSATION_MAX_TURNS', '20')),
+        max_senders=int(os.getenv('CONVERSATION_MAX_SENDERS', '10000')),
+        idle_ttl=float(os.getenv('CONVERSATION_IDLE_TTL_SECONDS', '3600')),
+    )
+    backend = os.getenv('CONVERSATION_BACKEND', 'memory')
+    if backend == 'sqlite':
+        return SQLiteConversationStore(os.getenv('CONVERSATION_SQLITE_PATH', 'conversations.sqlite3'), **settings)
+    if backend == 'memory':
+        return ConversationStore(**settings)
+    raise ValueError(f'Unknown CONVERSATION_BACKEND: {backend}')
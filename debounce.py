@@ -0,0 +1,306 @@
+"""Coalescing of messages a sender sends in quick succession.
+
+People often split one question over several short WhatsApp messages. Each
+would otherwise get its own completion and its own partial answer. The
+Coalescer holds a sender's messages until they have been quiet for window
+seconds, or until the first of them has waited max_wait seconds, and hands
+them over as one message whose text is the fragments joined by newlines.
+
+The threaded server calls start() with a function to receive each closed
+window; the ASGI server instead waits on remaining() and calls take().
+
+A Coalescer only sees the messages that reach its own process. With several
+worker processes, which gunicorn and uvicorn --workers hand webhooks to in
+turn, SQLiteCoalescer keeps the windows in a file they all share.
+"""
+import contextlib
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from workers import PerProcess
+
+logger = logging.getLogger(__name__)
+
+
+class Pending:
+    """Messages held for one sender: their texts, when the first arrived
+    (time.monotonic(), for the queue stage) and its wamid."""
+
+    __slots__ = ('texts', 'received', 'message_id', 'opened', 'due')
+
+    def __init__(self, text, received, message_id, opened, due):
+        self.texts = [text]
+        self.received = received
+        self.message_id = message_id
+        self.opened = opened
+        self.due = due
+
+    @property
+    def text(self):
+        return '\n'.join(self.texts)
+
+
+class Coalescer:
+    """Thread-safe windows keyed by sender."""
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, window, max_wait):
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self._pending = {}
+        # (due, key) for every add once start() has been called; entries
+        # whose key was taken or has moved its due time are skipped.
+        self._heap = []
+        self._flush = None
+        self._start_thread = PerProcess(self._start)
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, text, received=None, message_id=None, now=None):
+        """Hold text for key. Returns True if it opened a new window, False
+        if it joined one already open."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = Pending(
+                    text, now if received is None else received, message_id, now, now + self.window,
+                )
+                opened = True
+            else:
+                pending.texts.append(text)
+                pending.due = min(now + self.window, pending.opened + self.max_wait)
+                opened = False
+            if self._flush is not None:
+                heapq.heappush(self._heap, (pending.due, key))
+                if self._heap[0][1] == key:
+                    self._wake.notify()
+        if not opened:
+            metrics.inc('messages_coalesced')
+        return opened
+
+    def remaining(self, key, now=None):
+        """Seconds until key's window closes; 0 once it has, or if key has
+        nothing held."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            pending = self._pending.get(key)
+            return max(0.0, pending.due - now) if pending is not None else 0.0
+
+    def take(self, key, now=None):
+        """Remove and return key's Pending, or None."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is not None:
+            metrics.observe('stage_seconds', now - pending.opened, stage='debounce')
+        return pending
+
+    def take_due(self, now=None):
+        """Remove and return (key, Pending) for every window that has closed."""
+        now = self.clock() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                at, key = heapq.heappop(self._heap)
+                pending = self._pending.get(key)
+                if pending is not None and pending.due == at:
+                    due.append((key, self._pending.pop(key)))
+        for _, pending in due:
+            metrics.observe('stage_seconds', now - pending.opened, stage='debounce')
+        return due
+
+    def start(self, flush):
+        """Call flush(key, pending) from a background thread as each window
+        closes."""
+        if self._flush is None:
+            with self._lock:
+                if self._flush is None:
+                    self._flush = flush
+                    self._heap = [(pending.due, key) for key, pending in self._pending.items()]
+                    heapq.heapify(self._heap)
+        self._start_thread()
+
+    def _start(self):
+        self._wake = threading.Condition(self._lock)
+        threading.Thread(target=self._run, name='debounce', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._heap or self._heap[0][0] > self.clock():
+                    self._wake.wait(self._heap[0][0] - self.clock() if self._heap else None)
+            for key, pending in self.take_due():
+                try:
+                    self._flush(key, pending)
+                except Exception:
+                    logger.exception('could not hand over held messages')
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS held_messages (
+    key TEXT PRIMARY KEY,
+    texts TEXT NOT NULL,
+    received REAL,
+    message_id TEXT,
+    opened REAL NOT NULL,
+    due REAL NOT NULL
+)
+"""
+
+
+class SQLiteCoalescer(Coalescer):
+    """Windows shared by every process that opens the same database file.
+
+    The process whose message opens a window answers it; messages that reach
+    other processes are added to its row and push its due time back. Times
+    are time.time(), which every process agrees on.
+    """
+
+    clock = staticmethod(time.time)
+    PURGE_EVERY = 1000
+    # A window this long overdue was left by a process that exited before
+    # answering it; its messages are dropped and the sender starts afresh.
+    STALE_AFTER = 60
+
+    def __init__(self, path, window, max_wait):
+        super().__init__(window, max_wait)
+        self.path = path
+        self._local = threading.local()
+        self._opened = 0
+        # Use a throwaway connection so nothing is inherited across fork().
+        conn = sqlite3.connect(path, timeout=30)
+        with conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+        conn.close()
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM held_messages').fetchone()[0]
+
+    def add(self, key, text, received=None, message_id=None, now=None):
+        now = self.clock() if now is None else now
+        with self._transaction() as conn:
+            row = conn.execute('SELECT texts, opened, due FROM held_messages WHERE key = ?', (json.dumps(key),)).fetchone()
+            if row is not None and row[2] < now - self.STALE_AFTER:
+                logger.warning('dropping %d held messages left by a process that exited', len(json.loads(row[0])))
+                conn.execute('DELETE FROM held_messages WHERE key = ?', (json.dumps(key),))
+                row = None
+            if row is None:
+                due = now + self.window
+                conn.execute(
+                    'INSERT INTO held_messages (key, texts, received, message_id, opened, due) VALUES (?, ?, ?, ?, ?, ?)',
+                    (json.dumps(key), json.dumps([text]), now if received is None else received, message_id, now, due),
+                )
+            else:
+                due = min(now + self.window, row[1] + self.max_wait)
+                conn.execute(
+                    'UPDATE held_messages SET texts = ?, due = ? WHERE key = ?',
+                    (json.dumps(json.loads(row[0]) + [text]), due, json.dumps(key)),
+                )
+        if row is not None:
+            metrics.inc('messages_coalesced')
+            return False
+        with self._lock:
+            if self._flush is not None:
+                heapq.heappush(self._heap, (due, key))
+                if self._heap[0][1] == key:
+                    self._wake.notify()
+        self._opened += 1
+        if self._opened % self.PURGE_EVERY == 0:
+            with self._transaction() as conn:
+                conn.execute('DELETE FROM held_messages WHERE due < ?', (now - self.STALE_AFTER,))
+        return True
+
+    def remaining(self, key, now=None):
+        now = self.clock() if now is None else now
+        row = self._conn().execute('SELECT due FROM held_messages WHERE key = ?', (json.dumps(key),)).fetchone()
+        return max(0.0, row[0] - now) if row is not None else 0.0
+
+    def take(self, key, now=None):
+        now = self.clock() if now is None else now
+        with self._transaction() as conn:
+            pending = self._pop(conn, key)
+        if pending is not None:
+            metrics.observe('stage_seconds', now - pending.opened, stage='debounce')
+        return pending
+
+    def take_due(self, now=None):
+        now = self.clock() if now is None else now
+        with self._lock:
+            popped = []
+            while self._heap and self._heap[0][0] <= now:
+                popped.append(heapq.heappop(self._heap)[1])
+        due = []
+        for key in popped:
+            with self._transaction() as conn:
+                row = conn.execute('SELECT due FROM held_messages WHERE key = ?', (json.dumps(key),)).fetchone()
+                if row is None:
+                    continue
+                if row[0] > now:
+                    # Another process's message pushed the window back.
+                    with self._lock:
+                        heapq.heappush(self._heap, (row[0], key))
+                    continue
+                due.append((key, self._pop(conn, key)))
+        for _, pending in due:
+            metrics.observe('stage_seconds', now - pending.opened, stage='debounce')
+        return due
+
+    def _pop(self, conn, key):
+        row = conn.execute(
+            'SELECT texts, received, message_id, opened, due FROM held_messages WHERE key = ?', (json.dumps(key),),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute('DELETE FROM held_messages WHERE key = ?', (json.dumps(key),))
+        texts, received, message_id, opened, due = row
+        texts = json.loads(texts)
+        pending = Pending(texts[0], received, message_id, opened, due)
+        pending.texts = texts
+        return pending
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock before the row is read, so two
+        # processes cannot both open the same sender's window.
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+
+def create_coalescer():
+    """Coalescer for DEBOUNCE_SECONDS, or None when it is 0 (the default)."""
+    window = float(os.getenv('DEBOUNCE_SECONDS', '0'))
+    if window <= 0:
+        return None
+    max_wait = float(os.getenv('DEBOUNCE_MAX_SECONDS', '5'))
+    backend = os.getenv('DEBOUNCE_BACKEND', 'memory')
+    if backend == 'sqlite':
+        return SQLiteCoalescer(os.getenv('DEBOUNCE_SQLITE_PATH', 'debounce.sqlite3'), window, max_wait)
+    if backend == 'memory':
+        return Coalescer(window, max_wait)
+    raise ValueError(f'Unknown DEBOUNCE_BACKEND: {backend}')
@@ -0,0 +1,117 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class MemoryDedupeStore:
+    """In-process set of recently seen keys, bounded by size and age."""
+
+    def __init__(self, ttl=3600, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, key):
+        """Record key and return True if it was already seen within the TTL."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._seen:
+                return True
+            self._seen[key] = now + self.ttl
+            if len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        # Entries are inserted in expiry order, so only the head can be stale.
+        while self._seen:
+            key, expires = next(iter(self._seen.items()))
+            if expires > now:
+                break
+            self._seen.popitem(last=False)
+
+
+class SQLiteDedupeStore:
+    """Dedupe store shared by every process that opens the same database file."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._inserts = 0
+        # Use a throwaway connection so nothing is inherited across fork().
+        conn = sqlite3.connect(path, timeout=30)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS seen_messages (id TEXT PRIMARY KEY, expires REAL NOT NULL)')
+        conn.close()
+
+    def check_and_add(self, key):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM seen_messages WHERE id = ? AND expires <= ?', (key, now))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO seen_messages (id, expires) VALUES (?, ?)', (key, now + self.ttl)
+            )
+        if cursor.rowcount == 0:
+            return True
+        self._inserts += 1
+        if self._inserts % self.PURGE_EVERY == 0:
+            with conn:
+                conn.execute('DELETE FROM seen_messages WHERE expires <= ?', (now,))
+        return False
+
+    def forget(self, key):
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM seen_messages WHERE id = ?', (key,))
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM seen_messages').fetchone()[0]
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+
+def create_store():
+    backend = os.getenv('DEDUPE_BACKEND', 'memory')
+    ttl = float(os.getenv('DEDUPE_TTL_SECONDS', '86400'))
+    if backend == 'none':
+        return None
+    if backend == 'sqlite':
+        return SQLiteDedupeStore(os.getenv('DEDUPE_SQLITE_PATH', 'dedupe.sqlite3'), ttl)
+    if backend == 'memory':
+        return MemoryDedupeStore(ttl, int(os.getenv('DEDUPE_MAX_ENTRIES', '100000')))
+    raise ValueError(f'Unknown DEDUPE_BACKEND: {backend}')
+
+
+def is_duplicate(store, message_id):
+    """Return True (and count it) if message_id has already been handled."""
+    if store is None or not message_id:
+        return False
+    metrics.inc('dedupe_checked')
+    if store.check_and_add(message_id):
+        metrics.inc('dedupe_duplicates_dropped')
+        return True
+    return False
@@ -0,0 +1,148 @@
+"""Structured event log written as compact JSON lines by a background thread.
+
+log() only samples and enqueues, so a slow or blocked sink never holds up a
+request: once the bounded queue is full, events are dropped and counted in
+log_events_dropped. Redaction and serialisation happen on the writer thread.
+"""
+import hashlib
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import metrics
+from workers import PerProcess
+
+# Only values under these keys are logged as they are. Every other string
+# is replaced by its length and every other number dropped, so fields Meta
+# adds to its payloads later are redacted without anyone listing them.
+#
+# Ids of our own business numbers and of messages are safe to keep.
+KEEP_FIELDS = frozenset(('id', 'phone_number_id', 'timestamp'))
+# Values that describe a payload's shape rather than what a user sent, and
+# the reason and message count of our own webhook_rejected events.
+STRUCTURAL_FIELDS = frozenset((
+    'object', 'field', 'messaging_product', 'type', 'status', 'mime_type', 'code', 'reason', 'messages',
+))
+# Values under these keys are hashed so one sender's events can still be
+# correlated, without the number itself appearing in the logs.
+PHONE_FIELDS = frozenset(('from', 'to', 'wa_id', 'recipient_id', 'display_phone_number'))
+
+
+class EventLog:
+    def __init__(self, stream=None, queue_size=10000, sample_rates=None, redaction_key=b''):
+        self.stream = stream
+        self.sample_rates = sample_rates or {}
+        self.redaction_key = redaction_key or os.urandom(16)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._ensure_started = PerProcess(self._start)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        threading.Thread(target=self._run, name='eventlog', daemon=True).start()
+
+    def log(self, event, **fields):
+        rate = self.sample_rates.get(event, self.sample_rates.get('*', 1.0))
+        if rate < 1.0 and random.random() >= rate:
+            return
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.time(), event, fields))
+        except queue.Full:
+            metrics.inc('log_events_dropped')
+
+    def flush(self, timeout=5.0):
+        """Wait until queued events are written (for tests and shutdown)."""
+        done = threading.Event()
+        self._ensure_started()
+        try:
+            self._queue.put((None, None, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def open_stream(self):
+        """The sink, looked up on the writer thread before each batch."""
+        return self.stream or sys.stdout
+
+    def redact_phone(self, number):
+        digest = hashlib.blake2b(str(number).encode(), key=self.redaction_key, digest_size=6)
+        return 'phone:' + digest.hexdigest()
+
+    def redact(self, value, key=None):
+        if isinstance(value, dict):
+            return {k: self.redact(v, k) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.redact(v, key) for v in value]
+        if key in KEEP_FIELDS or key in STRUCTURAL_FIELDS or value is None or isinstance(value, bool):
+            return value
+        if key in PHONE_FIELDS:
+            return self.redact_phone(value)
+        if isinstance(value, str):
+            return f'<{len(value)} chars>'
+        return '<redacted>'
+
+    def format(self, ts, event, fields):
+        record = {'ts': round(ts, 3), 'event': event}
+        record.update(self.redact(fields))
+        return json.dumps(record, separators=(',', ':'), default=str)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Write whatever else is already queued in the same call.
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            waiters = []
+            for ts, event, fields in batch:
+                if event is None:
+                    waiters.append(fields)
+                    continue
+                try:
+                    lines.append(self.format(ts, event, fields))
+                except Exception:
+                    metrics.inc('log_events_dropped')
+            if lines:
+                try:
+                    stream = self.open_stream()
+                    stream.write('\n'.join(lines) + '\n')
+                    stream.flush()
+                except Exception:
+                    metrics.inc('log_events_dropped', len(lines))
+            for done in waiters:
+                done.set()
+
+
+def parse_sample_rates(value):
+    """'webhook=0.1,*=1' -> {'webhook': 0.1, '*': 1.0}."""
+    rates = {}
+    for item in value.split(','):
+        name, _, rate = item.partition('=')
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def create_log():
+    sink = os.getenv('LOG_SINK', 'stdout')
+    if sink == 'none':
+        return None
+    if sink == 'stdout':
+        stream = None
+    elif sink == 'stderr':
+        stream = sys.stderr
+    else:
+        stream = open(sink, 'a', buffering=1 << 16)
+    return EventLog(
+        stream,
+        queue_size=int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+        sample_rates=parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', '')),
+        redaction_key=os.getenv('LOG_REDACTION_KEY', '').encode(),
+    )
@@ -0,0 +1,117 @@
+import json
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import pacing
+import resilience
+import tracing
+
+GRAPH_API_URL = os.getenv('GRAPH_API_URL', 'https://graph.facebook.com/v18.0')
+GRAPH_POOL_SIZE = int(os.getenv('GRAPH_POOL_SIZE', '32'))
+GRAPH_CONNECT_TIMEOUT = float(os.getenv('GRAPH_CONNECT_TIMEOUT', '3.05'))
+GRAPH_READ_TIMEOUT = float(os.getenv('GRAPH_READ_TIMEOUT', '10'))
+
+# Sends that fail with a 429, a 5xx or a connection error are retried with
+# backoff; repeated failures open the breaker so sends fail fast for a while.
+retry_policy = resilience.policy_from_env('GRAPH')
+breaker = resilience.breaker_from_env('graph')
+
+# Sends wait for a slot under Meta's per-number and per-recipient limits.
+# Each process paces on its own, so with several workers divide the rates.
+pacer = pacing.create_pacer()
+
+# Graph error codes for rate limits, which Meta returns as 400s: app-level
+# throttling, business account, business number throughput, and too many
+# messages to one recipient.
+RATE_LIMIT_ERRORS = {4, 80007, 130429, 131056}
+PAIR_RATE_LIMITED = 131056
+
+
+def create_session(pool_size=GRAPH_POOL_SIZE):
+    """Session whose connections to the Graph API are kept alive and reused.
+
+    urllib3's pool is thread-safe, so one session is shared by every worker;
+    pool_size caps how many idle keep-alive connections are kept per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Content-Type': 'application/json'})
+    return session
+
+
+session = create_session()
+
+
+def messages_url(phone_number_id):
+    return f"{GRAPH_API_URL}/{phone_number_id}/messages"
+
+
+def text_message(to, text):
+    return {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "text": {"body": text}
+    }
+
+
+def auth_headers(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def error_code(body):
+    try:
+        return json.loads(body)['error']['code']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def check_status(response, status, headers, body=b'', phone_number_id=None, to=None):
+    """Raise Transient for a response worth retrying; return it otherwise."""
+    retry_after = resilience.parse_retry_after(headers.get('Retry-After'))
+    if status == 429 or status >= 500:
+        raise resilience.Transient(response, retry_after=retry_after, failure=status >= 500)
+    if status >= 400:
+        code = error_code(body)
+        if code in RATE_LIMIT_ERRORS:
+            metrics.inc('graph_rate_limited', code=code)
+            if pacer is not None and phone_number_id is not None:
+                pacer.rate_limited(phone_number_id, to, pair=code == PAIR_RATE_LIMITED)
+            raise resilience.Transient(response, retry_after=retry_after, failure=False)
+        metrics.inc('graph_send_failed', status=status)
+    return response
+
+
+def classify(exc):
+    # A message may already have been delivered when the read times out, so
+    # only failures to connect are retried.
+    if isinstance(exc, requests.ConnectionError):
+        return resilience.Transient()
+    if isinstance(exc, requests.Timeout):
+        return resilience.Transient(retry=False)
+    return None
+
+
+def send_text(phone_number_id, to, text, token, http=None):
+    def attempt():
+        if pacer is not None:
+            pacer.wait(phone_number_id, to)
+        response = (http or session).post(
+            messages_url(phone_number_id),
+            json=text_message(to, text),
+            headers=auth_headers(token),
+            timeout=(GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT),
+        )
+        return check_status(response, response.status_code, response.headers, response.content, phone_number_id, to)
+
+    started = time.monotonic()
+    try:
+        with tracing.span('graph.send', phone_number_id=phone_number_id):
+            return resilience.call(attempt, 'graph', retry_policy, breaker, classify)
+    finally:
+        metrics.observe('stage_seconds', time.monotonic() - started, stage='send')
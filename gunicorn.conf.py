@@ -0,0 +1,32 @@
+# Gunicorn settings for server:app. Every value can be overridden through the
+# environment or on the command line (python run.py --server gunicorn --workers 4).
+import multiprocessing
+import os
+
+
+def _flag(name, default='false'):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+bind = os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# Requests spend most of their time waiting on OpenAI and the Graph API, so
+# threaded workers get far more concurrency per process than sync ones.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '64'))
+# gthread workers answered ~3x fewer webhooks per second with keep-alive
+# enabled in benchmarks/bench_servers.py, so it is off unless asked for.
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '0'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+preload_app = _flag('GUNICORN_PRELOAD')
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+accesslog = os.getenv('GUNICORN_ACCESSLOG') or None
+
+
+def post_worker_init(worker):
+    # Answer messages a crashed worker left in the inbox without waiting for
+    # the next webhook.
+    import server
+    server.start_inbox()
@@ -0,0 +1,319 @@
+"""Durable queue of inbound messages in a SQLite database in WAL mode.
+
+Messages are written to disk before /webhook acknowledges them, so a crash
+between the acknowledgement and the reply no longer loses them: Meta will not
+redeliver a webhook it got a 200 for. Workers claim messages, answer them and
+mark them complete, which deletes them. Claims are leases held by a process;
+when the process dies its claims are released on the next start (or once the
+lease runs out, for claims made on another host) and the messages are
+answered again.
+
+Every write goes through one thread per process, which commits whatever has
+queued up since the last commit in a single transaction, so concurrent
+webhooks share one fsync instead of paying for one each.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+from workers import PerProcess
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS inbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT UNIQUE,
+    args TEXT NOT NULL,
+    enqueued REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_by TEXT,
+    claimed_until REAL NOT NULL DEFAULT 0
+)'''
+
+
+class Claimed:
+    """A message handed to a worker: its row, wamid, process_message args
+    and when it was enqueued (wall clock)."""
+
+    __slots__ = ('row_id', 'message_id', 'args', 'enqueued', 'attempts')
+
+    def __init__(self, row_id, message_id, args, enqueued, attempts):
+        self.row_id = row_id
+        self.message_id = message_id
+        self.args = args
+        self.enqueued = enqueued
+        self.attempts = attempts
+
+    def received(self):
+        """enqueued on the time.monotonic() clock, for the queue stage."""
+        return time.monotonic() - max(0.0, time.time() - self.enqueued)
+
+
+def _owner_pid(owner, host):
+    name, _, pid = owner.rpartition(':')
+    return int(pid) if name == host and pid.isdigit() else None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Inbox:
+    """Messages waiting to be answered, shared by every process using path.
+
+    put(), claim() and complete() return Futures resolved once the writer
+    thread has committed them; batch_size caps the operations per commit.
+    Messages claimed max_attempts times without completing are dropped, so
+    one that crashes the process cannot do it forever.
+    """
+
+    def __init__(self, path, batch_size=500, lease_seconds=300, max_attempts=3,
+                 synchronous='NORMAL', poll_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.synchronous = synchronous
+        self.poll_interval = poll_interval
+        self._ops = queue.Queue()
+        self._ready = threading.Condition()
+        self._consumers = None
+        self._owner = None
+        self._start_writer = PerProcess(self._start_writer_thread)
+        self._start_consumers = PerProcess(self._start_consumer_threads)
+        self.generation = 0
+        # Use a throwaway connection so nothing is inherited across fork().
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute(SCHEMA)
+        conn.close()
+
+    def _start_writer_thread(self):
+        self._ops = queue.Queue()
+        self._ready = threading.Condition()
+        self._owner = f'{socket.gethostname()}:{os.getpid()}'
+        threading.Thread(target=self._run, name='inbox', daemon=True).start()
+
+    def _ensure_started(self):
+        self._start_writer()
+        if self._consumers is not None:
+            self._start_consumers()
+
+    def _submit(self, op, data):
+        self._ensure_started()
+        future = Future()
+        self._ops.put((op, data, future))
+        return future
+
+    def put(self, jobs):
+        """Persist (message_id, args) pairs. The Future's result is how many
+        were new; message ids already waiting are ignored."""
+        return self._submit('put', [(message_id, json.dumps(args)) for message_id, args in jobs])
+
+    def claim(self, limit=1, numbers=None, excluding=()):
+        """Lease up to limit waiting messages to this process, oldest first;
+        the Future's result is a list of Claimed. numbers keeps to messages
+        to those business numbers (args[0]) and excluding leaves those out."""
+        return self._submit('claim', (limit, tuple(numbers) if numbers is not None else None, tuple(excluding)))
+
+    def complete(self, row_ids):
+        return self._submit('complete', list(row_ids))
+
+    def depth(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM inbox').fetchone()[0]
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Transactions are begun by hand: a claim must read and update its
+        # rows under one write lock, or two processes could claim the same row.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        return conn
+
+    def _recover(self, conn):
+        """Release claims held by processes on this host that have exited."""
+        host = self._owner.rpartition(':')[0]
+        owners = [row[0] for row in conn.execute(
+            'SELECT DISTINCT claimed_by FROM inbox WHERE claimed_by IS NOT NULL'
+        )]
+        dead = [owner for owner in owners
+                if (pid := _owner_pid(owner, host)) is not None and pid != os.getpid() and not _alive(pid)]
+        released = 0
+        if dead:
+            conn.execute('BEGIN IMMEDIATE')
+            for owner in dead:
+                released += conn.execute(
+                    'UPDATE inbox SET claimed_by = NULL, claimed_until = 0 WHERE claimed_by = ?', (owner,)
+                ).rowcount
+            conn.execute('COMMIT')
+        if released:
+            metrics.inc('inbox_replayed', released)
+        return released
+
+    def _put(self, conn, rows):
+        now = time.time()
+        before = conn.total_changes
+        conn.executemany(
+            'INSERT OR IGNORE INTO inbox (message_id, args, enqueued) VALUES (?, ?, ?)',
+            [(message_id, args, now) for message_id, args in rows],
+        )
+        return conn.total_changes - before
+
+    def _claim(self, conn, request):
+        limit, numbers, excluding = request
+        now = time.time()
+        where, params = 'claimed_until <= ?', [now]
+        if numbers is not None:
+            where += f" AND json_extract(args, '$[0]') IN ({', '.join('?' * len(numbers))})"
+            params += numbers
+        if excluding:
+            where += f" AND json_extract(args, '$[0]') NOT IN ({', '.join('?' * len(excluding))})"
+            params += excluding
+        rows = conn.execute(
+            f'SELECT id, message_id, args, enqueued, attempts FROM inbox WHERE {where} ORDER BY id LIMIT ?',
+            (*params, limit),
+        ).fetchall()
+        abandoned = [row[0] for row in rows if row[4] >= self.max_attempts]
+        if abandoned:
+            conn.executemany('DELETE FROM inbox WHERE id = ?', [(row_id,) for row_id in abandoned])
+            metrics.inc('inbox_abandoned', len(abandoned))
+        claimed = [Claimed(row_id, message_id, json.loads(args), enqueued, attempts + 1)
+                   for row_id, message_id, args, enqueued, attempts in rows if attempts < self.max_attempts]
+        conn.executemany(
+            'UPDATE inbox SET claimed_by = ?, claimed_until = ?, attempts = ? WHERE id = ?',
+            [(self._owner, now + self.lease_seconds, item.attempts, item.row_id) for item in claimed],
+        )
+        return claimed
+
+    def _complete(self, conn, row_ids):
+        conn.executemany('DELETE FROM inbox WHERE id = ?', [(row_id,) for row_id in row_ids])
+        return len(row_ids)
+
+    def _next_batch(self):
+        batch = [self._ops.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._ops.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = self._connect()
+        self._recover(conn)
+        apply = {'put': self._put, 'claim': self._claim, 'complete': self._complete}
+        while True:
+            batch = self._next_batch()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                results = [apply[op](conn, data) for op, data, _ in batch]
+                conn.execute('COMMIT')
+            except sqlite3.Error as exc:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                for _, _, future in batch:
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(exc)
+                continue
+            metrics.inc('inbox_commits')
+            for (op, _, future), result in zip(batch, results):
+                if op == 'put':
+                    metrics.inc('inbox_enqueued', result)
+                    if result:
+                        with self._ready:
+                            self.generation += 1
+                            # Consumers kept to some numbers cannot tell
+                            # whose message it is; all of them look.
+                            if len(self._consumers or ()) > 1:
+                                self._ready.notify_all()
+                            else:
+                                self._ready.notify(result)
+                elif op == 'complete':
+                    metrics.inc('inbox_completed', result)
+                # A caller that stopped waiting cancels its Future; the
+                # write has still been made.
+                if future.set_running_or_notify_cancel():
+                    future.set_result(result)
+
+    def wait(self, seen, timeout):
+        """Block until a put commits in this process after generation seen,
+        or timeout passes."""
+        with self._ready:
+            if self.generation == seen:
+                self._ready.wait(timeout)
+
+    def start(self, handler, workers, groups=()):
+        """Answer messages on workers threads, calling handler(*args,
+        received=..., message_id=...) for each, messages left over from a
+        crash included. groups are (name, workers, numbers): that many
+        threads of their own answer messages to those business numbers,
+        and the other threads leave them alone."""
+        excluding = [number for _, _, numbers in groups for number in numbers]
+        self._consumers = [(handler, 'inbox', workers, None, excluding)] + [
+            (handler, f'inbox-{name}', group_workers, list(numbers), ())
+            for name, group_workers, numbers in groups
+        ]
+        self._ensure_started()
+
+    def _start_consumer_threads(self):
+        for handler, name, workers, numbers, excluding in self._consumers:
+            for i in range(workers):
+                threading.Thread(
+                    target=self._consume, args=(handler, numbers, excluding), name=f'{name}-{i}', daemon=True,
+                ).start()
+
+    def _consume(self, handler, numbers=None, excluding=()):
+        while True:
+            seen = self.generation
+            try:
+                claimed = self.claim(1, numbers, excluding).result()
+            except sqlite3.Error:
+                metrics.inc('inbox_errors')
+                time.sleep(self.poll_interval)
+                continue
+            if not claimed:
+                # Puts from this process wake a worker at once; polling
+                # picks up other processes' messages and expired leases.
+                self.wait(seen, self.poll_interval)
+                continue
+            for item in claimed:
+                try:
+                    handler(*item.args, received=item.received(), message_id=item.message_id)
+                except Exception:
+                    logger.exception('inbox message failed')
+                # A failure is final, as with the in-memory queue; only a
+                # crash leaves the message to be answered again.
+                self.complete([item.row_id])
+
+
+def create_inbox():
+    """Inbox at INBOX_PATH, or None when it is unset."""
+    path = os.getenv('INBOX_PATH')
+    if not path:
+        return None
+    return Inbox(
+        path,
+        batch_size=int(os.getenv('INBOX_BATCH_SIZE', '500')),
+        lease_seconds=float(os.getenv('INBOX_LEASE_SECONDS', '300')),
+        max_attempts=int(os.getenv('INBOX_MAX_ATTEMPTS', '3')),
+        synchronous=os.getenv('INBOX_SYNCHRONOUS', 'NORMAL').upper(),
+    )
@@ -0,0 +1,153 @@
+"""In-process counters, gauges and latency histograms, rendered for Prometheus.
+
+Counters and histograms are striped: each thread writes to one of STRIPES
+shards with its own lock, so instrumented hot paths on different threads do
+not contend; readers add the shards up. Gauges are set rarely and share one
+lock. Every metric may carry labels, passed as keyword arguments.
+"""
+import bisect
+import itertools
+import math
+import threading
+
+STRIPES = 16
+
+# Seconds; suits everything from JSON parsing to a slow completion.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Stripe:
+    __slots__ = ('lock', 'counters', 'histograms')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        # key -> [count per bucket..., count above the last bucket, sum]
+        self.histograms = {}
+
+
+_stripes = [_Stripe() for _ in range(STRIPES)]
+_next_stripe = itertools.count()
+_local = threading.local()
+
+_gauge_lock = threading.Lock()
+_gauges = {}
+_buckets = {}
+
+
+def _assign_stripe():
+    # Thread idents are aligned addresses and hash badly, so threads are
+    # dealt stripes in turn instead.
+    _local.stripe = _stripes[next(_next_stripe) % STRIPES]
+    return _local.stripe
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items()))) if labels else (name, ())
+    try:
+        stripe = _local.stripe
+    except AttributeError:
+        stripe = _assign_stripe()
+    with stripe.lock:
+        stripe.counters[key] = stripe.counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _gauge_lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Record one sample in the histogram name (LATENCY_BUCKETS by default)."""
+    key = (name, tuple(sorted(labels.items()))) if labels else (name, ())
+    bounds = _buckets.setdefault(name, buckets)
+    try:
+        stripe = _local.stripe
+    except AttributeError:
+        stripe = _assign_stripe()
+    with stripe.lock:
+        histogram = stripe.histograms.get(key)
+        if histogram is None:
+            histogram = stripe.histograms[key] = [0] * (len(bounds) + 2)
+        histogram[bisect.bisect_left(bounds, value)] += 1
+        histogram[-1] += value
+
+
+def _merged():
+    counters, histograms = {}, {}
+    for stripe in _stripes:
+        with stripe.lock:
+            for key, value in stripe.counters.items():
+                counters[key] = counters.get(key, 0) + value
+            for key, values in stripe.histograms.items():
+                total = histograms.get(key)
+                histograms[key] = list(values) if total is None else [a + b for a, b in zip(total, values)]
+    with _gauge_lock:
+        gauges = dict(_gauges)
+    return counters, gauges, histograms
+
+
+def get(name, **labels):
+    """Current value of a counter or gauge; <histogram>_count and _sum also work."""
+    key = _key(name, labels)
+    counters, gauges, histograms = _merged()
+    if key in gauges:
+        return gauges[key]
+    if key in counters:
+        return counters[key]
+    for suffix, index in (('_count', None), ('_sum', -1)):
+        if name.endswith(suffix):
+            values = histograms.get(_key(name[:-len(suffix)], labels))
+            if values is not None:
+                return sum(values[:-1]) if index is None else values[index]
+    return 0
+
+
+def _series(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return name
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return name + '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def snapshot():
+    """Flat {series: value}; histograms appear as their _count and _sum."""
+    counters, gauges, histograms = _merged()
+    result = {_series(name, labels): value for (name, labels), value in counters.items()}
+    result.update((_series(name, labels), value) for (name, labels), value in gauges.items())
+    for (name, labels), values in histograms.items():
+        result[_series(name + '_count', labels)] = sum(values[:-1])
+        result[_series(name + '_sum', labels)] = values[-1]
+    return result
+
+
+def _number(value):
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Everything recorded so far in the Prometheus text exposition format."""
+    counters, gauges, histograms = _merged()
+    lines = []
+    for kind, series in (('counter', counters), ('gauge', gauges)):
+        for name, group in itertools.groupby(sorted(series.items()), key=lambda item: item[0][0]):
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{_series(name, labels)} {_number(value)}' for (_, labels), value in group)
+    for name, group in itertools.groupby(sorted(histograms.items()), key=lambda item: item[0][0]):
+        lines.append(f'# TYPE {name} histogram')
+        bounds = _buckets[name] + (math.inf,)
+        for (_, labels), values in group:
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                lines.append(f'{_series(name + "_bucket", labels, [("le", _number(float(bound)))])} {cumulative}')
+            lines.append(f'{_series(name + "_sum", labels)} {_number(values[-1])}')
+            lines.append(f'{_series(name + "_count", labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,145 @@
+"""Pacing of outbound Graph API sends.
+
+Meta caps how fast one business number may send (80 messages a second by
+default) and how often one recipient may be messaged (about one message
+every 6 seconds, with short bursts allowed). Sends over either limit fail
+with error 130429 or 131056. The Pacer gives each send a time slot that
+keeps within both limits, and the sender waits for it. A burst of replies is
+then spread out instead of being rejected.
+
+Slots follow the generic cell rate algorithm: each key stores the time its
+next send is due, so a reservation is one comparison per limit and nothing
+runs in the background.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class Backlogged(Exception):
+    """The next free slot is further away than the pacer's max_delay."""
+
+
+class Schedule:
+    """Due times per key for rate sends a second with bursts of up to
+    burst, holding at most max_keys keys in least-recently-used order.
+
+    Sends leave the process a few milliseconds after their slot, and not
+    always in slot order, so bursts are cut short by slack seconds' worth of
+    sends; the steady rate is unchanged.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000, slack=0.1):
+        self.interval = 1 / rate
+        # How far ahead of schedule a send may go; burst sends back to back.
+        self.tolerance = max(0.0, (burst - 1) * self.interval - slack)
+        self.max_keys = max_keys
+        self._due = OrderedDict()
+
+    def earliest(self, key, now):
+        due = self._due.get(key)
+        return now if due is None else max(now, due - self.tolerance)
+
+    def book(self, key, at):
+        due = self._due.get(key)
+        self._due[key] = max(at, due if due is not None else at) + self.interval
+        self._due.move_to_end(key)
+        while len(self._due) > self.max_keys:
+            self._due.popitem(last=False)
+
+    def hold(self, key, now):
+        """Treat key's burst as spent: its next send waits a full interval."""
+        self._due[key] = max(self._due.get(key, now), now + self.tolerance + self.interval)
+        self._due.move_to_end(key)
+
+
+class Pacer:
+    """Thread-safe slots per business number and per recipient; either
+    schedule may be None to leave that limit unpaced."""
+
+    def __init__(self, number, recipient, max_delay=30.0):
+        self.number = number
+        self.recipient = recipient
+        self.max_delay = max_delay
+        self._waiting = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, phone_number_id, to, now=None):
+        """Book the earliest slot for a send and return the seconds until it.
+        Raises Backlogged, booking nothing, if that is over max_delay."""
+        now = time.monotonic() if now is None else now
+        pair = (phone_number_id, to)
+        with self._lock:
+            at = now
+            if self.number is not None:
+                at = self.number.earliest(phone_number_id, at)
+            if self.recipient is not None:
+                at = max(at, self.recipient.earliest(pair, now))
+            if at - now > self.max_delay:
+                metrics.inc('graph_pacing_rejected')
+                raise Backlogged(f'{phone_number_id}: next send slot is {at - now:.1f}s away')
+            if self.number is not None:
+                self.number.book(phone_number_id, at)
+            if self.recipient is not None:
+                self.recipient.book(pair, at)
+            if at > now:
+                waiting = self._waiting[phone_number_id] = self._waiting.get(phone_number_id, 0) + 1
+                metrics.set_gauge('graph_send_queue_depth', waiting, phone_number_id=phone_number_id)
+        metrics.observe('stage_seconds', at - now, stage='pace')
+        return at - now
+
+    def _done(self, phone_number_id):
+        with self._lock:
+            waiting = self._waiting[phone_number_id] - 1
+            if waiting:
+                self._waiting[phone_number_id] = waiting
+            else:
+                del self._waiting[phone_number_id]
+            metrics.set_gauge('graph_send_queue_depth', waiting, phone_number_id=phone_number_id)
+
+    def wait(self, phone_number_id, to):
+        delay = self.reserve(phone_number_id, to)
+        if delay > 0:
+            try:
+                time.sleep(delay)
+            finally:
+                self._done(phone_number_id)
+
+    async def wait_async(self, phone_number_id, to):
+        delay = self.reserve(phone_number_id, to)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._done(phone_number_id)
+
+    def rate_limited(self, phone_number_id, to, pair):
+        """Meta refused a send: hold back the number, or only the recipient
+        when pair is true, as if its burst were used up."""
+        now = time.monotonic()
+        with self._lock:
+            if pair and self.recipient is not None:
+                self.recipient.hold((phone_number_id, to), now)
+            elif not pair and self.number is not None:
+                self.number.hold(phone_number_id, now)
+
+
+def create_pacer():
+    """Pacer from GRAPH_NUMBER_* and GRAPH_RECIPIENT_* settings, or None
+    when both rates are 0."""
+    max_keys = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+    slack = float(os.getenv('GRAPH_PACING_SLACK', '0.1'))
+    number_rate = float(os.getenv('GRAPH_NUMBER_RATE_PER_SECOND', '80'))
+    recipient_rate = float(os.getenv('GRAPH_RECIPIENT_RATE_PER_MINUTE', '10')) / 60
+    number = recipient = None
+    if number_rate > 0:
+        number = Schedule(number_rate, float(os.getenv('GRAPH_NUMBER_BURST', '80')), max_keys, slack)
+    if recipient_rate > 0:
+        recipient = Schedule(recipient_rate, float(os.getenv('GRAPH_RECIPIENT_BURST', '45')), max_keys, slack)
+    if number is None and recipient is None:
+        return None
+    return Pacer(number, recipient, float(os.getenv('GRAPH_PACING_MAX_DELAY', '30')))
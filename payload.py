@@ -0,0 +1,131 @@
+"""Typed view of WhatsApp webhook payloads, built in a single pass.
+
+parse() decodes the raw request body (with orjson when it is installed) and
+walks it once into slotted dataclasses. Besides the nested entries and
+changes, the result lists every message and status of the batch directly,
+each tagged with the business number it was sent to. Fields Meta leaves out
+come through as None, so callers never trip over a missing key.
+"""
+import json
+from dataclasses import dataclass, field
+
+try:
+    import orjson
+except ImportError:  # optional: the standard library is only slower
+    orjson = None
+
+WHATSAPP_OBJECT = 'whatsapp_business_account'
+
+
+@dataclass(slots=True)
+class Contact:
+    wa_id: str
+    name: str = None
+
+
+@dataclass(slots=True)
+class Message:
+    id: str
+    from_number: str
+    phone_number_id: str
+    type: str = None
+    timestamp: str = None
+    # Body of a text message; None for images, locations, reactions and so on.
+    text: str = None
+
+
+@dataclass(slots=True)
+class Status:
+    id: str
+    status: str
+    recipient_id: str
+    phone_number_id: str
+    timestamp: str = None
+    errors: list = None
+
+
+@dataclass(slots=True)
+class Change:
+    field: str
+    phone_number_id: str
+    display_phone_number: str = None
+    contacts: list = field(default_factory=list)
+    messages: list = field(default_factory=list)
+    statuses: list = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class Entry:
+    id: str
+    changes: list = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class Webhook:
+    object: str
+    entries: list = field(default_factory=list)
+    # Every message and status in the batch, in order.
+    messages: list = field(default_factory=list)
+    statuses: list = field(default_factory=list)
+    # The decoded JSON, for logging.
+    body: dict = field(default=None, repr=False)
+
+    @property
+    def is_whatsapp(self):
+        return self.object == WHATSAPP_OBJECT
+
+
+def loads(raw):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _dict(value):
+    return value if isinstance(value, dict) else {}
+
+
+def _list(value):
+    return value if isinstance(value, list) else ()
+
+
+def from_dict(body):
+    """Build a Webhook from already-decoded JSON."""
+    if not isinstance(body, dict):
+        raise ValueError('webhook payload is not a JSON object')
+    webhook = Webhook(body.get('object'), body=body)
+    messages, statuses = webhook.messages, webhook.statuses
+    for raw_entry in _list(body.get('entry')):
+        raw_entry = _dict(raw_entry)
+        entry = Entry(raw_entry.get('id'))
+        webhook.entries.append(entry)
+        for raw_change in _list(raw_entry.get('changes')):
+            raw_change = _dict(raw_change)
+            value = _dict(raw_change.get('value'))
+            metadata = _dict(value.get('metadata'))
+            phone_number_id = metadata.get('phone_number_id')
+            change = Change(raw_change.get('field'), phone_number_id, metadata.get('display_phone_number'))
+            entry.changes.append(change)
+            for contact in _list(value.get('contacts')):
+                contact = _dict(contact)
+                change.contacts.append(Contact(contact.get('wa_id'), _dict(contact.get('profile')).get('name')))
+            for raw in _list(value.get('messages')):
+                raw = _dict(raw)
+                message = Message(
+                    raw.get('id'), raw.get('from'), phone_number_id, raw.get('type'), raw.get('timestamp'),
+                    _dict(raw.get('text')).get('body'),
+                )
+                change.messages.append(message)
+                messages.append(message)
+            for raw in _list(value.get('statuses')):
+                raw = _dict(raw)
+                status = Status(
+                    raw.get('id'), raw.get('status'), raw.get('recipient_id'), phone_number_id,
+                    raw.get('timestamp'), raw.get('errors'),
+                )
+                change.statuses.append(status)
+                statuses.append(status)
+    return webhook
+
+
+def parse(raw):
+    """Decode a webhook request body into a Webhook; ValueError if it is not one."""
+    return from_dict(loads(raw))
@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated', 'notified')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        # Set once the owner has been told they are over the limit, so a
+        # flood gets one canned reply rather than one per message.
+        self.notified = False
+
+
+class RateLimiter:
+    """Token buckets per key, holding at most max_keys of them.
+
+    Buckets are kept in least-recently-used order. One that has been idle
+    long enough to refill completely is indistinguishable from a new bucket,
+    so it is dropped, and beyond max_keys the least recently used goes too.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._refill_time = burst / rate
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now=None):
+        """Take a token for key. Returns (allowed, first_rejection)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+                self._buckets.move_to_end(key)
+            self._evict(now)
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                bucket.notified = False
+                return True, False
+            first, bucket.notified = not bucket.notified, True
+            return False, first
+
+    def _evict(self, now):
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+            if now - bucket.updated < self._refill_time:
+                break
+            self._buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def create_limiter(prefix, default_rate, default_burst):
+    """Limiter configured by <prefix>_PER_MINUTE and <prefix>_BURST; 0 disables."""
+    per_minute = float(os.getenv(f'{prefix}_PER_MINUTE', default_rate))
+    if per_minute <= 0:
+        return None
+    return RateLimiter(
+        per_minute / 60,
+        float(os.getenv(f'{prefix}_BURST', default_burst)),
+        int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000')),
+    )
+
+
+class Limits:
+    """Per-sender and per-business-number limits applied before any LLM call."""
+
+    def __init__(self, sender, number, reply):
+        self.sender = sender
+        self.number = number
+        self.reply = reply
+
+    def check(self, phone_number_id, from_number):
+        """Return None if allowed, else the canned reply to send ('' for none)."""
+        now = time.monotonic()
+        if self.sender is not None:
+            allowed, first = self.sender.acquire((phone_number_id, from_number), now)
+            if not allowed:
+                metrics.inc('rate_limited_sender')
+                return self.reply if first else ''
+        if self.number is not None:
+            allowed, first = self.number.acquire(phone_number_id, now)
+            if not allowed:
+                metrics.inc('rate_limited_number')
+                return ''
+        return None
+
+
+def create_limits():
+    return Limits(
+        create_limiter('SENDER_RATE', '20', '5'),
+        create_limiter('NUMBER_RATE', '0', '50'),
+        os.getenv('RATE_LIMIT_REPLY', "You're sending messages too quickly. Please wait a moment and try again."),
+    )
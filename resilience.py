@@ -0,0 +1,202 @@
+"""Retries with jittered exponential backoff, and circuit breakers.
+
+A dependency call is retried only for errors the caller marks as transient,
+waiting full-jitter exponential backoff or the server's Retry-After,
+whichever is longer. A circuit breaker per dependency counts consecutive
+failures. Once it opens, calls fail fast with CircuitOpen until reset_timeout
+has passed. Then a single trial call decides whether it closes again.
+"""
+import asyncio
+import email.utils
+import itertools
+import os
+import random
+import threading
+import time
+
+import metrics
+
+
+class CircuitOpen(Exception):
+    """The dependency's breaker is open; the call was not attempted."""
+
+    def __init__(self, name, state):
+        super().__init__(f'{name} circuit is {state}')
+        self.name = name
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    metrics.inc(f'{self.name}_breaker_rejected')
+                    raise CircuitOpen(self.name, 'open')
+                self.state = self.HALF_OPEN
+                self._opened_at = time.monotonic()
+                return
+            if self.state == self.HALF_OPEN:
+                # Only the trial call goes through while half-open, unless it
+                # never reported back (e.g. it was cancelled).
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    metrics.inc(f'{self.name}_breaker_rejected')
+                    raise CircuitOpen(self.name, 'half-open')
+                self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self.state = self.CLOSED
+                metrics.inc(f'{self.name}_breaker_closed')
+
+    def record_neutral(self):
+        """The call said nothing about the dependency's health. It neither
+        resets nor adds to the failures; while half-open the next call is
+        let through as the trial instead."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._opened_at -= self.reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    metrics.inc(f'{self.name}_breaker_opened')
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    def __init__(self, max_retries=2, base_delay=0.5, max_delay=8.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number attempt (0-based), or None to give up."""
+        if attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                # Waiting that long would hold a worker; let the caller fail over.
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Transient(Exception):
+    """Raised by an operation to request a retry; carries the final result."""
+
+    def __init__(self, result=None, retry_after=None, failure=True, retry=True):
+        super().__init__(result)
+        self.result = result
+        self.retry_after = retry_after
+        # failure=False for errors that say nothing about the dependency's
+        # health, such as a 429; retry=False for ones not safe to repeat.
+        self.failure = failure
+        self.retry = retry
+
+
+def _next_delay(exc, attempt, name, policy, breaker, classify):
+    """Seconds to wait before attempting again, or None to give up on exc."""
+    transient = exc if isinstance(exc, Transient) else (classify(exc) if classify else None)
+    if breaker is not None:
+        # Only a returned call counts as a success; a 429 or an error the
+        # classifier does not know must not reset the failures seen so far.
+        if transient is not None and transient.failure:
+            breaker.record_failure()
+        else:
+            breaker.record_neutral()
+    if transient is None:
+        return None
+    delay = policy.delay(attempt, transient.retry_after) if transient.retry else None
+    metrics.inc(f'{name}_retries' if delay is not None else f'{name}_retries_exhausted')
+    return delay
+
+
+def call(operation, name, policy, breaker=None, classify=None):
+    """Run operation() with retries and the breaker.
+
+    classify(exc) turns an exception into a Transient, or None to propagate
+    it unchanged. When retries run out on a Transient raised by operation,
+    its result is returned instead of raised.
+    """
+    for attempt in itertools.count():
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = operation()
+        except Exception as exc:
+            delay = _next_delay(exc, attempt, name, policy, breaker, classify)
+            if delay is None:
+                if isinstance(exc, Transient):
+                    return exc.result
+                raise
+            time.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+async def call_async(operation, name, policy, breaker=None, classify=None):
+    """Coroutine version of call(); operation() returns an awaitable."""
+    for attempt in itertools.count():
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = await operation()
+        except Exception as exc:
+            delay = _next_delay(exc, attempt, name, policy, breaker, classify)
+            if delay is None:
+                if isinstance(exc, Transient):
+                    return exc.result
+                raise
+            await asyncio.sleep(delay)
+            continue
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+
+def policy_from_env(prefix):
+    return RetryPolicy(
+        max_retries=int(os.getenv(f'{prefix}_MAX_RETRIES', '2')),
+        base_delay=float(os.getenv('RETRY_BASE_DELAY', '0.5')),
+        max_delay=float(os.getenv('RETRY_MAX_DELAY', '8')),
+    )
+
+
+def breaker_from_env(name):
+    threshold = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+    if threshold <= 0:
+        return None
+    return CircuitBreaker(name, threshold, float(os.getenv('BREAKER_RESET_SECONDS', '30')))
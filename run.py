@@ -0,0 +1,104 @@
+"""Launch the webhook server.
+
+    python run.py                      # gunicorn with gunicorn.conf.py
+    python run.py --server uvicorn     # asgi.py on uvicorn
+    python run.py --server dev         # Flask's debug server, for local work
+
+The server can also be picked with the SERVER environment variable. Options
+not listed here are passed straight to gunicorn or uvicorn.
+
+With more than one worker process, state that has to follow a sender from
+one webhook to the next defaults to SQLite files the workers share.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def gunicorn_command(args, extra):
+    command = [sys.executable, '-m', 'gunicorn', '--config', os.path.join(HERE, 'gunicorn.conf.py')]
+    if args.bind:
+        command += ['--bind', args.bind]
+    if args.workers is not None:
+        command += ['--workers', str(args.workers)]
+    if args.threads is not None:
+        command += ['--threads', str(args.threads)]
+    if args.worker_class:
+        command += ['--worker-class', args.worker_class]
+    if args.keepalive is not None:
+        command += ['--keep-alive', str(args.keepalive)]
+    if args.graceful_timeout is not None:
+        command += ['--graceful-timeout', str(args.graceful_timeout)]
+    if args.preload:
+        command.append('--preload')
+    return command + extra + ['server:app']
+
+
+def uvicorn_command(args, extra):
+    # uvicorn reads WEB_CONCURRENCY and UVICORN_* variables itself.
+    host, _, port = (args.bind or os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '8000')}")).rpartition(':')
+    command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', host, '--port', port, '--no-access-log']
+    if args.workers is not None:
+        command += ['--workers', str(args.workers)]
+    if args.keepalive is not None:
+        command += ['--timeout-keep-alive', str(args.keepalive)]
+    if args.graceful_timeout is not None:
+        command += ['--timeout-graceful-shutdown', str(args.graceful_timeout)]
+    return command + extra
+
+
+def worker_count(args):
+    if args.workers is not None:
+        return args.workers
+    if os.getenv('WEB_CONCURRENCY'):
+        return int(os.getenv('WEB_CONCURRENCY'))
+    # gunicorn.conf.py's default; uvicorn runs one process unless told otherwise.
+    return multiprocessing.cpu_count() * 2 + 1 if args.server == 'gunicorn' else 1
+
+
+def share_state(workers):
+    """Default per-sender state to SQLite when webhooks are spread over
+    several processes, and warn when it is explicitly kept in memory."""
+    if workers <= 1:
+        return
+    for backend, enabled in (
+        ('DEBOUNCE_BACKEND', float(os.getenv('DEBOUNCE_SECONDS', '0')) > 0),
+        ('CONVERSATION_BACKEND', int(os.getenv('CONVERSATION_TOKEN_BUDGET', '1000')) > 0),
+    ):
+        os.environ.setdefault(backend, 'sqlite')
+        if enabled and os.environ[backend] == 'memory':
+            print(
+                f'warning: {backend}=memory with {workers} worker processes; each keeps its own '
+                'state, so a sender whose webhooks reach different workers is not tracked as one',
+                file=sys.stderr,
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('gunicorn', 'uvicorn', 'dev'), default=os.getenv('SERVER', 'gunicorn'))
+    parser.add_argument('--bind', help='host:port to listen on (default $BIND or 0.0.0.0:$PORT)')
+    parser.add_argument('--workers', type=int, help='worker processes (default $WEB_CONCURRENCY)')
+    parser.add_argument('--threads', type=int, help='threads per gunicorn worker')
+    parser.add_argument('--worker-class', help='gunicorn worker class')
+    parser.add_argument('--keepalive', type=int, help='seconds to hold idle keep-alive connections')
+    parser.add_argument('--graceful-timeout', type=int, help='seconds to finish in-flight work on shutdown')
+    parser.add_argument('--preload', action='store_true', help='import the app before forking workers')
+    args, extra = parser.parse_known_args(argv)
+
+    if args.server == 'dev':
+        from server import app
+        app.run(debug=True)
+        return
+
+    share_state(worker_count(args))
+    command = gunicorn_command(args, extra) if args.server == 'gunicorn' else uvicorn_command(args, extra)
+    os.chdir(HERE)
+    os.execv(command[0], command)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
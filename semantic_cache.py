@@ -0,0 +1,149 @@
+"""Answer cache that also matches paraphrased questions.
+
+Questions are embedded offline with signed feature hashing of words, word
+pairs and character trigrams, so no model or network call is needed. That
+only catches rewordings that keep most of the words, and questions that
+differ in one word still score high, hence the strict default threshold.
+Vectors live in one preallocated float32 matrix; a lookup is a single
+matrix-vector product. NumPy is only required when the cache is enabled.
+"""
+import os
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import metrics
+from cache import normalize
+
+
+# Whole words and word pairs outweigh the character trigrams, so questions
+# that differ in one word (monday and sunday share most trigrams) end up
+# further apart.
+WORD_WEIGHT = 2.0
+PAIR_WEIGHT = 3.0
+
+
+def _features(text):
+    """(feature, weight) pairs: words, their character trigrams and word pairs."""
+    words = normalize(text).split()
+    for word in words:
+        yield word, WORD_WEIGHT
+        padded = f' {word} '
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3], 1.0
+    # Word pairs keep some word order, so "usd to eur" and "eur to usd"
+    # differ; the separator keeps them apart from any single word.
+    for first, second in zip(words, words[1:]):
+        yield f'{first}|{second}', PAIR_WEIGHT
+
+
+def embed(text, dim=256, out=None):
+    """Unit-length hashed n-gram vector for text."""
+    vector = np.zeros(dim, dtype=np.float32) if out is None else out
+    for feature, weight in _features(text):
+        h = zlib.crc32(feature.encode())
+        vector[h % dim] += weight if h & 0x80000000 else -weight
+    norm = float(np.linalg.norm(vector))
+    if norm:
+        vector /= norm
+    return vector
+
+
+def embed_batch(texts, dim=256):
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in zip(matrix, texts):
+        embed(text, dim, out=row)
+    return matrix
+
+
+class SemanticCache:
+    """Fixed-capacity vector index of answered questions with LRU eviction."""
+
+    def __init__(self, max_entries=10000, dim=256, threshold=0.95, ttl=3600):
+        self.max_entries = max_entries
+        self.dim = dim
+        self.threshold = threshold
+        self.ttl = ttl
+        self.size = 0
+        self._vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self._tenants = np.zeros(max_entries, dtype=np.int32)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._answers = [None] * max_entries
+        self._tenant_codes = {}
+        self._lock = threading.Lock()
+
+    def _tenant_code(self, tenant):
+        return self._tenant_codes.setdefault(tenant, len(self._tenant_codes) + 1)
+
+    def get(self, tenant, query):
+        answer = self.get_batch(tenant, [query])[0]
+        metrics.inc('semantic_cache_hits' if answer is not None else 'semantic_cache_misses')
+        return answer
+
+    def get_batch(self, tenant, queries):
+        """Best cached answer (or None) for each query, in one matrix product."""
+        vectors = embed_batch(queries, self.dim)
+        now = time.monotonic()
+        with self._lock:
+            if not self.size:
+                return [None] * len(queries)
+            code = self._tenant_codes.get(tenant)
+            scores = self._vectors[:self.size] @ vectors.T
+            # Only rows above the threshold can answer, and there are few of
+            # them, so tenant and expiry are checked on those rather than
+            # masking the whole index.
+            rows, columns = np.nonzero(scores >= self.threshold)
+            valid = (self._tenants[rows] == code) & (self._expires[rows] > now)
+            rows, columns = rows[valid], columns[valid]
+            best = [None] * len(queries)
+            for row, column in zip(rows.tolist(), columns.tolist()):
+                if best[column] is None or scores[row, column] > scores[best[column], column]:
+                    best[column] = row
+            results = []
+            for row in best:
+                if row is None:
+                    results.append(None)
+                else:
+                    self._last_used[row] = now
+                    results.append(self._answers[row])
+            return results
+
+    def put(self, tenant, query, answer):
+        vector = embed(query, self.dim)
+        now = time.monotonic()
+        with self._lock:
+            if self.size < self.max_entries:
+                row = self.size
+                self.size += 1
+            else:
+                # Evict an expired entry if there is one, else the least recently used.
+                row = int(np.where(self._expires <= now, -np.inf, self._last_used).argmin())
+                metrics.inc('semantic_cache_evictions')
+            self._vectors[row] = vector
+            self._tenants[row] = self._tenant_code(tenant)
+            self._last_used[row] = now
+            self._expires[row] = now + self.ttl
+            self._answers[row] = answer
+
+    def __len__(self):
+        return self.size
+
+
+def create_cache():
+    max_entries = int(os.getenv('SEMANTIC_CACHE_SIZE', '0'))
+    if max_entries <= 0:
+        return None
+    if np is None:
+        raise RuntimeError('SEMANTIC_CACHE_SIZE is set but numpy is not installed')
+    return SemanticCache(
+        max_entries=max_entries,
+        dim=int(os.getenv('SEMANTIC_CACHE_DIM', '256')),
+        threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95')),
+        ttl=float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '3600')),
+    )
@@ -1,9 +1,41 @@
 from flask import Flask, request
-import requests
 import os
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import contextlib
+import contextvars
+import logging
+import queue
+import threading
+import openai
 from openai import OpenAI
-client = OpenAI()
+from workers import WorkerPool
+import dedupe
+import graph
+import conversation
+import cache
+import semantic_cache
+import streaming
+import metrics
+import splitter
+import ratelimit
+import concurrency
+import resilience
+import eventlog
+import tracing
+import payload
+import signature
+import statuses
+import inbox
+import tenancy
+import debounce
+
+# The SDK's own retries are off; chat_ai retries transient errors itself so
+# OPENAI_MAX_RETRIES and the circuit breaker see every attempt.
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '60'))
+client = OpenAI(timeout=OPENAI_TIMEOUT, max_retries=0)
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
@@ -13,52 +45,502 @@ WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
 
-def chat_ai(query):
-    completion = client.chat.completions.create(
-    model="gpt-3.5-turbo",
-    messages=[
-    {"role": "system", "content": "You are my personal helpful assistant. Please answer my question precisely and to the point"},
-    {"role": "user", "content": query},
+# BACKGROUND_WORKERS > 0 acknowledges webhooks immediately and runs the
+# chat-and-reply pipeline on a pool of that many threads.
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', '0'))
+BACKGROUND_QUEUE_SIZE = int(os.getenv('BACKGROUND_QUEUE_SIZE', '1000'))
+
+# Upper bound on messages from one webhook batch processed at the same time
+# when running without background workers.
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+
+worker_pool = WorkerPool(BACKGROUND_WORKERS, BACKGROUND_QUEUE_SIZE) if BACKGROUND_WORKERS > 0 else None
+
+# With INBOX_PATH set, messages are written to that SQLite file before the
+# webhook is acknowledged and answered by INBOX_WORKERS threads, so messages
+# in flight when a process dies are answered after it restarts. Takes the
+# place of BACKGROUND_WORKERS.
+message_inbox = inbox.create_inbox()
+INBOX_WORKERS = int(os.getenv('INBOX_WORKERS', str(BACKGROUND_WORKERS or 16)))
+INBOX_PUT_TIMEOUT = float(os.getenv('INBOX_PUT_TIMEOUT', '5'))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+
+# Compact, redacted JSON lines written off the request path; LOG_SINK=none
+# turns them off.
+events = eventlog.create_log()
+
+# With APP_SECRET set, webhooks without a valid X-Hub-Signature-256 are
+# rejected before their body is parsed.
+verifier = signature.create_verifier()
+if verifier is None:
+    logger.warning('APP_SECRET is not set; webhook signatures are not checked')
+
+# Status-only callbacks are acknowledged without parsing unless
+# STATUS_CALLBACKS=full; with the default, aggregate, they are also counted
+# in batches off the request path.
+STATUS_FAST_PATH = os.getenv('STATUS_CALLBACKS', 'aggregate') != 'full'
+status_aggregator = statuses.create_aggregator(events)
+
+# Meta redelivers webhooks it considers slow or failed; remember wamids so a
+# redelivery never triggers a second completion and reply.
+dedupe_store = dedupe.create_store()
+
+# With DEBOUNCE_SECONDS set, messages a sender sends in quick succession are
+# held and answered together, with one completion, once they stop.
+coalescer = debounce.create_coalescer()
+# Closed windows of tenants without a worker pool are answered on this one,
+# BATCH_CONCURRENCY at a time, rather than on a webhook's request.
+held_pool = WorkerPool(BATCH_CONCURRENCY, BACKGROUND_QUEUE_SIZE, name='held') if coalescer is not None else None
+
+# Recent turns per sender, replayed to the model within a token budget.
+conversations = conversation.create_store()
+
+# Answers to questions asked before, for business numbers that allow it.
+response_cache = cache.create_cache()
+RESPONSE_CACHE_DISABLED_FOR = cache.disabled_tenants()
+# Optional second tier that also matches paraphrases of cached questions.
+semantic = semantic_cache.create_cache()
+
+# STREAM_REPLIES sends long answers as several messages while the completion
+# is still streaming, each at least STREAM_MIN_CHUNK_CHARS long.
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'false').lower() in ('1', 'true', 'yes', 'on')
+STREAM_MIN_CHUNK_CHARS = int(os.getenv('STREAM_MIN_CHUNK_CHARS', '300'))
+
+# Token buckets per sender and per business number, checked before any LLM call.
+limits = ratelimit.create_limits()
+
+# With ADAPTIVE_CONCURRENCY, calls to OpenAI wait for a slot under a limit
+# that grows while latency is healthy and halves on 429s and timeouts.
+OPENAI_OVERLOAD_ERRORS = (openai.RateLimitError, openai.APITimeoutError)
+llm_limiter = concurrency.from_env(concurrency.AdaptiveLimiter, 'llm', OPENAI_OVERLOAD_ERRORS)
+
+openai_retry_policy = resilience.policy_from_env('OPENAI')
+openai_breaker = resilience.breaker_from_env('openai')
+# Sent instead of an answer when OpenAI is failing or overloaded; empty
+# leaves the message unanswered.
+FALLBACK_REPLY = os.getenv('FALLBACK_REPLY', "Sorry, I can't answer right now. Please try again in a few minutes.")
+
+MODEL = "gpt-3.5-turbo"
+SYSTEM_PROMPT = "You are my personal helpful assistant. Please answer my question precisely and to the point"
+
+# Business numbers listed in TENANTS_FILE get their own token, model, prompt,
+# limits and pools; every other number uses the settings above.
+default_tenant = tenancy.Tenant(
+    'default', WHATSAPP_TOKEN, MODEL, SYSTEM_PROMPT, limits, client, graph.session, worker_pool,
+)
+tenants = tenancy.load(
+    default_tenant, lambda api_key: OpenAI(api_key=api_key, timeout=OPENAI_TIMEOUT, max_retries=0),
+)
+
+def build_messages(query, history=(), system_prompt=SYSTEM_PROMPT):
+    return [
+        {"role": "system", "content": system_prompt},
+        *history,
+        {"role": "user", "content": query},
     ]
-  )
 
+def llm_slot():
+    return llm_limiter.slot() if llm_limiter is not None else contextlib.nullcontext()
+
+def openai_retry_after(headers):
+    retry_after_ms = resilience.parse_retry_after(headers.get('retry-after-ms'))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return resilience.parse_retry_after(headers.get('retry-after'))
+
+def classify_openai_error(exc):
+    # APITimeoutError is an APIConnectionError.
+    if isinstance(exc, (openai.APIConnectionError, openai.InternalServerError)):
+        return resilience.Transient()
+    if isinstance(exc, openai.RateLimitError) and exc.code != 'insufficient_quota':
+        return resilience.Transient(retry_after=openai_retry_after(exc.response.headers), failure=False)
+    return None
+
+def call_openai(operation):
+    return resilience.call(operation, 'openai', openai_retry_policy, openai_breaker, classify_openai_error)
+
+def record_usage(usage, tenant=default_tenant):
+    if usage is not None:
+        metrics.inc('openai_tokens', usage.prompt_tokens, type='prompt', tenant=tenant.name)
+        metrics.inc('openai_tokens', usage.completion_tokens, type='completion', tenant=tenant.name)
+
+def chat_ai(query, history=(), tenant=default_tenant):
+    messages = build_messages(query, history, tenant.system_prompt)
+
+    def attempt():
+        # A slot per attempt, so the limiter sees each 429 and timeout.
+        with llm_slot():
+            return tenant.client.chat.completions.create(model=tenant.model, messages=messages)
+
+    started = time.monotonic()
+    with tracing.span('llm', model=tenant.model):
+        completion = call_openai(attempt)
+    metrics.observe('stage_seconds', time.monotonic() - started, stage='llm')
+    record_usage(completion.usage, tenant)
     return completion.choices[0].message.content
 
+def open_stream(messages, tenant=default_tenant):
+    """Start a streamed completion; returns it with the slot it holds."""
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(llm_slot())
+        stream = tenant.client.chat.completions.create(
+            model=tenant.model, messages=messages, stream=True, stream_options={"include_usage": True},
+        )
+        return stack.pop_all(), stream
+
+def read_stream(messages, tenant=default_tenant):
+    # Only opening the stream is retried; once tokens have been sent on to
+    # the user a retry would repeat them.
+    started = time.monotonic()
+    with tracing.span('llm', model=tenant.model, stream=True):
+        slot, stream = call_openai(lambda: open_stream(messages, tenant))
+        with slot:
+            for chunk in stream:
+                # The last chunk carries usage and no choices.
+                record_usage(chunk.usage, tenant)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    metrics.observe('stage_seconds', time.monotonic() - started, stage='llm')
+
+def chat_ai_stream(query, history=(), tenant=default_tenant):
+    """Yield the completion's text as it streams. Another thread reads the
+    stream, so the LLM slot and timings do not include the time the caller
+    spends sending what has arrived."""
+    messages = build_messages(query, history, tenant.system_prompt)
+    deltas = queue.Queue()
+    stopped = threading.Event()
+
+    def read():
+        try:
+            for delta in read_stream(messages, tenant):
+                if stopped.is_set():
+                    break
+                deltas.put(delta)
+        except Exception as exc:
+            deltas.put(exc)
+        finally:
+            deltas.put(None)
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(read,), name='llm-stream', daemon=True).start()
+    try:
+        while True:
+            delta = deltas.get()
+            if delta is None:
+                return
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+    finally:
+        stopped.set()
+
+def reply_text(x, index=0):
+    return f"Answer from AI -> {x}" if index == 0 else x
+
+def send_text(phone_number_id, to, text):
+    """Send text from phone_number_id with its tenant's token and connections."""
+    tenant = tenants.get(phone_number_id)
+    return graph.send_text(phone_number_id, to, text, tenant.token, tenant.session)
+
+def send_reply(phone_number_id, from_number, x, index=0, started=None):
+    # Parts go out one after another on this thread, so they arrive in
+    # order; after a failed part the rest would read out of context.
+    for part in splitter.split_message(reply_text(x, index)):
+        response = send_text(phone_number_id, from_number, part)
+        if started is not None:
+            # The user sees the answer once its first part arrives.
+            metrics.observe('time_to_first_message_seconds', time.monotonic() - started)
+            started = None
+        if not response.ok:
+            break
+    return response
+
+def stream_answer(phone_number_id, from_number, msg_body, history, tenant=default_tenant):
+    """Stream a completion, sending each chunk as soon as it is complete."""
+    reply = streaming.StreamedReply(STREAM_MIN_CHUNK_CHARS)
+    responses = []
+    try:
+        for delta in chat_ai_stream(msg_body, history, tenant):
+            for index, chunk in reply.push(delta):
+                responses.append(send_reply(phone_number_id, from_number, chunk, index))
+                reply.sent(chunk)
+    except Exception as exc:
+        if reply.sent_text and llm_unavailable(exc):
+            raise streaming.CutOff(reply.sent_text, responses, exc) from exc
+        raise
+    for index, chunk in reply.finish():
+        responses.append(send_reply(phone_number_id, from_number, chunk, index))
+        reply.sent(chunk)
+    return reply.text, responses
+
+def llm_unavailable(exc):
+    """True when exc means OpenAI gave no answer, rather than Graph failing."""
+    if isinstance(exc, resilience.CircuitOpen):
+        return exc.name == 'openai'
+    return isinstance(exc, (concurrency.Overloaded, openai.APIError))
+
+def send_fallback(phone_number_id, from_number):
+    metrics.inc('llm_fallback_replies')
+    return send_text(phone_number_id, from_number, FALLBACK_REPLY) if FALLBACK_REPLY else None
+
+def conversation_key(phone_number_id, from_number):
+    return (phone_number_id, from_number)
+
+def cache_key(phone_number_id, msg_body, history):
+    # Follow-ups depend on the conversation so far; only opening questions
+    # are answered from or stored in the cache.
+    if response_cache is None or history or phone_number_id in RESPONSE_CACHE_DISABLED_FOR:
+        return None
+    if not tenants.get(phone_number_id).response_cache:
+        return None
+    return (phone_number_id, cache.normalize(msg_body))
+
+def lookup_cached(cached, msg_body):
+    if not cached:
+        return None
+    x = response_cache.get(cached)
+    if x is None and semantic is not None:
+        x = semantic.get(cached[0], msg_body)
+    return x
+
+def store_cached(cached, msg_body, x):
+    if cached:
+        response_cache.put(cached, x)
+        if semantic is not None:
+            semantic.put(cached[0], msg_body, x)
+
+def process_message(phone_number_id, from_number, msg_body, received=None, message_id=None):
+    """Answer one message; received is when its webhook arrived."""
+    started = time.monotonic()
+    tenant = tenants.get(phone_number_id)
+    metrics.inc('tenant_messages', tenant=tenant.name)
+    if received is not None:
+        metrics.observe('stage_seconds', started - received, stage='queue')
+    try:
+        with tracing.span('message', message_id, phone_number_id=phone_number_id, tenant=tenant.name):
+            return answer_message(phone_number_id, from_number, msg_body, started, tenant)
+    except Exception:
+        metrics.inc('message_errors', tenant=tenant.name)
+        raise
+    finally:
+        elapsed = time.monotonic() - (received or started)
+        metrics.observe('stage_seconds', elapsed, stage='end_to_end')
+        metrics.observe('tenant_message_seconds', elapsed, tenant=tenant.name)
+
+def answer_message(phone_number_id, from_number, msg_body, started, tenant=default_tenant):
+    limited = tenant.limits.check(phone_number_id, from_number)
+    if limited is not None:
+        return send_text(phone_number_id, from_number, limited) if limited else None
+    key = conversation_key(phone_number_id, from_number)
+    history = conversations.history(key) if conversations is not None else ()
+    cached = cache_key(phone_number_id, msg_body, history)
+    x = lookup_cached(cached, msg_body)
+    responses = []
+    if x is None:
+        try:
+            if STREAM_REPLIES:
+                x, responses = stream_answer(phone_number_id, from_number, msg_body, history, tenant)
+            else:
+                x = chat_ai(msg_body, history, tenant)
+        except streaming.CutOff as exc:
+            # Part of the answer has been sent; the fallback reply after it
+            # would contradict it. Keep what the user saw as the answer.
+            logger.warning('%s', exc)
+            metrics.inc('llm_answers_cut_off')
+            if conversations is not None:
+                conversations.record_exchange(key, msg_body, exc.text)
+            return exc.responses[-1]
+        except Exception as exc:
+            if not llm_unavailable(exc):
+                raise
+            logger.warning('no answer from OpenAI, sending the fallback reply: %r', exc)
+            return send_fallback(phone_number_id, from_number)
+        store_cached(cached, msg_body, x)
+    if conversations is not None:
+        conversations.record_exchange(key, msg_body, x)
+
+    if not responses:
+        responses.append(send_reply(phone_number_id, from_number, x, started=started))
+    return responses[-1]
+
+def collect_jobs(webhook, received=None):
+    """Return (message_id, process_message args) for each new text message."""
+    jobs = []
+    for message in webhook.messages:
+        if not message.text:
+            continue
+        if dedupe.is_duplicate(dedupe_store, message.id):
+            continue
+        jobs.append((message.id, (message.phone_number_id, message.from_number, message.text, received, message.id)))
+    return jobs
+
+def forget_messages(message_ids):
+    if dedupe_store is not None:
+        for message_id in message_ids:
+            if message_id:
+                dedupe_store.forget(message_id)
+
+def answer_inline(args):
+    """process_message() on the webhook's request. A failure answers 500,
+    so the message is forgotten for Meta's redelivery to answer it."""
+    try:
+        return process_message(*args)
+    except Exception:
+        forget_messages([args[4]])
+        raise
+
+def persist_jobs(jobs):
+    """Write jobs to the inbox; False if that failed or is taking longer than
+    INBOX_PUT_TIMEOUT, and Meta should redeliver."""
+    start_inbox()
+    future = message_inbox.put([(message_id, args[:3]) for message_id, args in jobs])
+    try:
+        future.result(INBOX_PUT_TIMEOUT)
+    except FutureTimeout:
+        inbox_write_late(future, jobs)
+        return False
+    except Exception:
+        logger.exception('could not write messages to the inbox')
+        forget_messages([message_id for message_id, _ in jobs])
+        return False
+    return True
+
+def inbox_write_late(future, jobs):
+    """The write is still queued and will most likely commit, and then the
+    messages are answered from the inbox. Their ids are kept, so Meta's
+    redelivery is dropped as a duplicate instead of answered a second time,
+    unless the write fails after all."""
+    message_ids = [message_id for message_id, _ in jobs]
+    logger.warning('inbox write of %d messages is taking longer than INBOX_PUT_TIMEOUT', len(message_ids))
+
+    def forget_if_failed(future):
+        if future.exception() is not None:
+            logger.error('could not write messages to the inbox', exc_info=future.exception())
+            forget_messages(message_ids)
+    future.add_done_callback(forget_if_failed)
+
+def start_inbox():
+    """Start answering inbox messages, including any left by a crash. Called
+    by gunicorn.conf.py as each worker boots, and by the first webhook."""
+    if message_inbox is not None:
+        message_inbox.start(process_message, INBOX_WORKERS, inbox_groups())
+
+def inbox_groups():
+    """(name, workers, numbers) for tenants with workers of their own, whose
+    inbox messages are answered by that many threads of their own."""
+    numbers = {}
+    for phone_number_id, tenant in tenants.by_number.items():
+        if tenant.workers > 0:
+            numbers.setdefault(tenant, []).append(phone_number_id)
+    return [(tenant.name, tenant.workers, tenant_numbers) for tenant, tenant_numbers in numbers.items()]
+
+def hold_message(args):
+    """Add a message to its sender's DEBOUNCE_SECONDS window."""
+    phone_number_id, from_number, msg_body, received, message_id = args
+    coalescer.start(answer_held)
+    coalescer.add(conversation_key(phone_number_id, from_number), msg_body, received, message_id)
+
+def answer_held(key, pending):
+    """Queue the messages of a closed window as one."""
+    args = (*key, pending.text, pending.received, pending.message_id)
+    tenant = tenants.get(key[0])
+    if not held_queue(tenant).submit(process_message, *args):
+        # The webhooks were acknowledged when the queue still had room.
+        metrics.inc('tenant_rejected', tenant=tenant.name)
+        logger.warning('queue full, dropping %d held messages from %s', len(pending.texts), tenant.name)
+
+def held_queue(tenant):
+    return tenant.pool if tenant.pool is not None else held_pool
+
+def queue_statuses(raw):
+    metrics.inc('webhook_status_only')
+    if status_aggregator is not None:
+        status_aggregator.add(raw)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    body = request.json
-
-    print(json.dumps(body, indent=2))
-
-    if body.get('object') == 'whatsapp_business_account':
-        if (
-            body.get('entry') and
-            body['entry'][0].get('changes') and
-            body['entry'][0]['changes'][0].get('value') and
-            body['entry'][0]['changes'][0]['value'].get('messages') and
-            body['entry'][0]['changes'][0]['value']['messages'][0]
-        ):
-            phone_number_id = body['entry'][0]['changes'][0]['value']['metadata']['phone_number_id']
-            from_number = body['entry'][0]['changes'][0]['value']['messages'][0]['from']
-            msg_body = body['entry'][0]['changes'][0]['value']['messages'][0]['text']['body']
-
-            x = chat_ai(msg_body)
-
-            send_message_url = f"https://graph.facebook.com/v18.0/{phone_number_id}/messages?access_token={WHATSAPP_TOKEN}"
-            response = requests.post(
-                send_message_url,
-                json={
-                    "messaging_product": "whatsapp",
-                    "to": from_number,
-                    "text": {"body": f"Answer from AI -> {x}"}
-                },
-                headers={"Content-Type": "application/json"}
-            )
+    received = time.monotonic()
+    raw = request.get_data()
+    if verifier is not None and not verifier.verify(raw, request.headers.get(signature.HEADER)):
+        return '', 401
+    if STATUS_FAST_PATH and statuses.is_status_only(raw):
+        queue_statuses(raw)
         return '', 200
-    else:
-        return '', 404
+    with tracing.span('webhook') as span:
+        try:
+            parsed = payload.parse(raw)
+        except ValueError:
+            return '', 400
+        metrics.observe('stage_seconds', time.monotonic() - received, stage='parse')
+
+        if events is not None:
+            events.log('webhook', payload=parsed.body)
+
+        if not parsed.is_whatsapp:
+            return '', 404
+        jobs = collect_jobs(parsed, received)
+        if jobs:
+            # Batches are rare; the span follows the first message.
+            span.message_id = jobs[0][0]
+
+        if message_inbox is not None:
+            if jobs and not persist_jobs(jobs):
+                if events is not None:
+                    events.log('webhook_rejected', reason='inbox_unavailable', messages=len(jobs))
+                return '', 503
+            return '', 200
+
+        # Each message goes to its tenant's worker pool, or is answered here
+        # when there is none. With DEBOUNCE_SECONDS it is held first and
+        # acknowledged, unless its tenant's queue is already full.
+        rejected, inline = [], []
+        for message_id, args in jobs:
+            tenant = tenants.get(args[0])
+            if coalescer is not None:
+                if held_queue(tenant).full():
+                    metrics.inc('tenant_rejected', tenant=tenant.name)
+                    rejected.append(message_id)
+                else:
+                    hold_message(args)
+            elif tenant.pool is None:
+                inline.append(args)
+            elif not tenant.pool.submit(process_message, *args):
+                metrics.inc('tenant_rejected', tenant=tenant.name)
+                rejected.append(message_id)
+        if len(inline) == 1:
+            answer_inline(inline[0])
+        elif inline:
+            list(batch_executor.map(answer_inline, inline))
+        if rejected:
+            # Queue is full; a non-2xx makes Meta redeliver the batch, so
+            # the messages we could not queue must not count as duplicates.
+            forget_messages(rejected)
+            if events is not None:
+                events.log('webhook_rejected', reason='queue_full', messages=len(rejected))
+            return '', 503
+        return '', 200
+
+
 
+@app.after_request
+def count_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.inc('http_requests', route=route, method=request.method, status=response.status_code)
+    return response
 
+@app.route('/metrics')
+def prometheus_metrics():
+    if worker_pool is not None:
+        metrics.set_gauge('background_queue_depth', worker_pool.qsize())
+    if message_inbox is not None:
+        metrics.set_gauge('inbox_depth', message_inbox.depth())
+    if coalescer is not None:
+        metrics.set_gauge('debounce_pending', len(coalescer))
+        metrics.set_gauge('debounce_queue_depth', held_pool.qsize())
+    for tenant in tenants.by_number.values():
+        if tenant.workers > 0:
+            metrics.set_gauge('tenant_queue_depth', tenant.pool.qsize(), tenant=tenant.name)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.route('/')
 def hello():
@@ -75,4 +557,5 @@ def verify_webhook():
         return 'Invalid Verify Token', 403
 
 if __name__ == '__main__':
-    app.run(debug = True)
+    import run
+    run.main()
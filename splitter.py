@@ -0,0 +1,86 @@
+"""Split long answers into WhatsApp-sized messages.
+
+Text is cut at the largest natural boundary that fits: between paragraphs
+and code blocks first, then between sentences, then between words. Code
+blocks too long for one message are split by line and each part is fenced
+again so it still renders as code.
+"""
+import re
+
+# WhatsApp rejects text messages whose body is longer than this.
+MAX_TEXT_LENGTH = 4096
+
+_CODE_BLOCK = re.compile(r'```.*?(?:```|\Z)', re.DOTALL)
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+# Zero-width split points, so joining the pieces gives back the original text.
+_SENTENCE_END = re.compile(r'(?<=[.!?…])(?=\s)')
+_WORD_START = re.compile(r'(?<=\s)(?=\S)')
+
+
+def _blocks(text):
+    """Yield (is_code, block) for code blocks and the paragraphs between them."""
+    position = 0
+    for match in _CODE_BLOCK.finditer(text):
+        yield from ((False, p) for p in _PARAGRAPH_BREAK.split(text[position:match.start()]))
+        yield True, match.group()
+        position = match.end()
+    yield from ((False, p) for p in _PARAGRAPH_BREAK.split(text[position:]))
+
+
+def _split_code(block, limit):
+    first_line, _, rest = block.partition('\n')
+    opening = first_line + '\n'
+    body = rest[:-3].rstrip('\n') if rest.endswith('```') else rest
+    room = limit - len(opening) - len('\n```')
+    if room <= 0:
+        return _split_prose(block, limit)
+    lines = []
+    for line in body.split('\n'):
+        # A single line longer than a message is cut; nothing else can help.
+        lines.extend(line[i:i + room] for i in range(0, max(len(line), 1), room))
+    return [opening + '\n'.join(part) + '\n```' for part in _pack(lines, room, '\n')]
+
+
+def _split_prose(block, limit):
+    pieces = []
+    for sentence in _SENTENCE_END.split(block):
+        if len(sentence) <= limit:
+            pieces.append(sentence)
+            continue
+        for word in _WORD_START.split(sentence):
+            pieces.extend(word[i:i + limit] for i in range(0, len(word), limit))
+    return [''.join(part).strip() for part in _pack(pieces, limit, '')]
+
+
+def _pack(pieces, limit, separator):
+    """Greedily group pieces into runs whose joined length stays within limit."""
+    groups, current, size = [], [], 0
+    for piece in pieces:
+        extra = len(piece) + (len(separator) if current else 0)
+        if current and size + extra > limit:
+            groups.append(current)
+            current, size = [], 0
+            extra = len(piece)
+        current.append(piece)
+        size += extra
+    if current:
+        groups.append(current)
+    return groups
+
+
+def split_message(text, limit=MAX_TEXT_LENGTH):
+    """Return text as an ordered list of strings no longer than limit."""
+    if len(text) <= limit:
+        return [text]
+    pieces = []
+    for is_code, block in _blocks(text):
+        block = block.strip('\n') if is_code else block.strip()
+        if not block:
+            continue
+        if len(block) <= limit:
+            pieces.append(block)
+        elif is_code:
+            pieces.extend(_split_code(block, limit))
+        else:
+            pieces.extend(_split_prose(block, limit))
+    return ['\n\n'.join(group) for group in _pack(pieces, limit, '\n\n')]
@@ -0,0 +1,97 @@
+"""Fast path for status callbacks (sent, delivered, read, failed).
+
+Meta posts a status update for every reply we send, so these outnumber
+incoming messages several times over. is_status_only() recognises them from
+the raw bytes without decoding the JSON, so /webhook can acknowledge them at
+once. An optional StatusAggregator parses them later, in batches, on a
+background thread, counting them by status and logging failed deliveries.
+"""
+import os
+import queue
+import re
+import threading
+import time
+
+import metrics
+import payload
+from workers import PerProcess
+
+
+# Keys only: every change also says "field": "messages". Quotes inside
+# message text are escaped, so these cannot match user content.
+MESSAGES_KEY = re.compile(rb'"messages"\s*:')
+STATUSES_KEY = re.compile(rb'"statuses"\s*:')
+
+
+def is_status_only(raw):
+    """True if raw is a WhatsApp webhook carrying statuses and no messages."""
+    return (
+        b'"whatsapp_business_account"' in raw
+        and STATUSES_KEY.search(raw) is not None
+        and MESSAGES_KEY.search(raw) is None
+    )
+
+
+class StatusAggregator:
+    """Parses queued status bodies in batches of up to batch_size, at least
+    every flush_interval seconds. A full queue drops bodies rather than
+    slowing the webhook."""
+
+    def __init__(self, batch_size=500, flush_interval=1.0, queue_size=10000, events=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.events = events
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._ensure_started = PerProcess(self._start)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        threading.Thread(target=self._run, name='statuses', daemon=True).start()
+
+    def add(self, raw):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(raw)
+        except queue.Full:
+            metrics.inc('status_callbacks_dropped')
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            counts = {}
+            for raw in self._next_batch():
+                try:
+                    webhook = payload.parse(raw)
+                except ValueError:
+                    continue
+                for status in webhook.statuses:
+                    counts[status.status] = counts.get(status.status, 0) + 1
+                    if status.status == 'failed' and self.events is not None:
+                        self.events.log('status_failed', id=status.id, recipient_id=status.recipient_id,
+                                        phone_number_id=status.phone_number_id, errors=status.errors)
+            for name, count in counts.items():
+                metrics.inc('whatsapp_statuses', count, status=name)
+
+
+def create_aggregator(events=None):
+    """StatusAggregator for STATUS_CALLBACKS=aggregate (the default), else None."""
+    if os.getenv('STATUS_CALLBACKS', 'aggregate') != 'aggregate':
+        return None
+    return StatusAggregator(
+        batch_size=int(os.getenv('STATUS_BATCH_SIZE', '500')),
+        flush_interval=float(os.getenv('STATUS_FLUSH_SECONDS', '1')),
+        queue_size=int(os.getenv('STATUS_QUEUE_SIZE', '10000')),
+        events=events,
+    )
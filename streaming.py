@@ -0,0 +1,97 @@
+import re
+import time
+
+import metrics
+
+# A paragraph break, or sentence-ending punctuation followed by whitespace.
+_BOUNDARY = re.compile(r'\n\s*\n|[.!?…](?=\s)')
+_FENCE = '```'
+
+
+class ChunkBuffer:
+    """Accumulates streamed text and releases it at sentence or paragraph ends.
+
+    Nothing is released before min_chars have accumulated, so a fast model
+    does not turn into a burst of one-line WhatsApp messages, and a chunk
+    never ends inside a ``` code block.
+    """
+
+    def __init__(self, min_chars=300):
+        self.min_chars = min_chars
+        self._buffer = ''
+
+    def feed(self, text):
+        self._buffer += text
+        chunks = []
+        while len(self._buffer) >= self.min_chars:
+            end = self._split_point()
+            if end is None:
+                break
+            chunk, self._buffer = self._buffer[:end].strip(), self._buffer[end:].lstrip()
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def flush(self):
+        chunk, self._buffer = self._buffer.strip(), ''
+        return [chunk] if chunk else []
+
+    def _split_point(self):
+        for match in _BOUNDARY.finditer(self._buffer, self.min_chars - 1):
+            end = match.end()
+            if self._buffer.count(_FENCE, 0, end) % 2 == 0:
+                return end
+        return None
+
+
+class CutOff(Exception):
+    """The stream failed after part of the answer had been sent: text is
+    what was sent and responses the sends' responses."""
+
+    def __init__(self, text, responses, cause):
+        super().__init__(f'answer cut off: {cause!r}')
+        self.text = text
+        self.responses = responses
+
+
+class StreamedReply:
+    """Turns completion deltas into numbered chunks to send, timing both ends.
+
+    Records time from the request to the first streamed token and to the
+    first message handed to WhatsApp.
+    """
+
+    def __init__(self, min_chars=300):
+        self.started = time.monotonic()
+        self._buffer = ChunkBuffer(min_chars)
+        self._parts = []
+        self._released = 0
+        self._sent = []
+
+    @property
+    def text(self):
+        return ''.join(self._parts)
+
+    def push(self, delta):
+        if not self._parts:
+            metrics.observe('llm_time_to_first_byte_seconds', time.monotonic() - self.started)
+        self._parts.append(delta)
+        return self._number(self._buffer.feed(delta))
+
+    def finish(self):
+        return self._number(self._buffer.flush())
+
+    @property
+    def sent_text(self):
+        """The chunks handed to WhatsApp so far."""
+        return '\n\n'.join(self._sent)
+
+    def sent(self, chunk):
+        if not self._sent:
+            metrics.observe('time_to_first_message_seconds', time.monotonic() - self.started)
+        self._sent.append(chunk)
+
+    def _number(self, chunks):
+        numbered = list(enumerate(chunks, self._released))
+        self._released += len(chunks)
+        return numbered
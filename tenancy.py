@@ -0,0 +1,149 @@
+"""Settings per WhatsApp business number, so one deployment serves several.
+
+TENANTS_FILE names a JSON object keyed by phone_number_id:
+
+    {
+      "1234567890": {
+        "name": "acme",
+        "token_env": "ACME_WHATSAPP_TOKEN",
+        "model": "gpt-4o-mini",
+        "system_prompt": "You answer questions about Acme's products.",
+        "workers": 16,
+        "queue_size": 500,
+        "sender_rate_per_minute": 30
+      }
+    }
+
+Every key but name is optional and falls back to the server-wide setting.
+Each tenant gets its own Graph API connection pool and, with workers set,
+its own worker pool, so a tenant flooded with messages queues behind its own
+workers instead of everyone's. Numbers not in the file use the default
+tenant, which is configured by the environment as before. The file is read
+once at startup; mistakes in it stop the server from starting.
+"""
+import json
+import os
+
+import graph
+import ratelimit
+from workers import WorkerPool
+
+FIELDS = {
+    'name', 'token', 'token_env', 'model', 'system_prompt', 'workers', 'queue_size', 'graph_pool_size',
+    'openai_api_key', 'openai_api_key_env', 'sender_rate_per_minute', 'sender_burst',
+    'number_rate_per_minute', 'number_burst', 'response_cache',
+}
+
+
+class Tenant:
+    """One business number's settings and bulkheads.
+
+    client is the OpenAI client it calls through, its own when it has its
+    own API key. session is its Graph API connection pool. pool is the
+    WorkerPool its messages go to, the server's unless it has workers of
+    its own; the ASGI server instead lets such a tenant answer workers
+    messages at once with queue_size more waiting.
+    """
+
+    def __init__(self, name, token, model, system_prompt, limits, client, session, pool=None,
+                 workers=0, queue_size=0, graph_pool_size=graph.GRAPH_POOL_SIZE, openai_api_key=None,
+                 response_cache=True):
+        self.name = name
+        self.token = token
+        self.model = model
+        self.system_prompt = system_prompt
+        self.limits = limits
+        self.client = client
+        self.session = session
+        self.pool = pool
+        self.workers = workers
+        self.queue_size = queue_size
+        self.graph_pool_size = graph_pool_size
+        self.openai_api_key = openai_api_key
+        self.response_cache = response_cache
+
+
+class Tenants:
+    def __init__(self, default, by_number=None):
+        self.default = default
+        self.by_number = by_number or {}
+
+    def get(self, phone_number_id):
+        return self.by_number.get(phone_number_id, self.default)
+
+    def __iter__(self):
+        yield self.default
+        yield from self.by_number.values()
+
+
+def _secret(config, key):
+    if key in config:
+        return config[key]
+    env = config.get(f'{key}_env')
+    if env is None:
+        return None
+    value = os.getenv(env)
+    if not value:
+        raise ValueError(f'{env} is not set')
+    return value
+
+
+def _limiter(config, key, fallback, burst_key, default_burst):
+    if key not in config:
+        return fallback
+    per_minute = float(config[key])
+    if per_minute <= 0:
+        return None
+    return ratelimit.RateLimiter(
+        per_minute / 60, float(config.get(burst_key, default_burst)), int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000')),
+    )
+
+
+def from_config(phone_number_id, config, default, make_client):
+    """Tenant for one entry of TENANTS_FILE; make_client(api_key) builds an
+    OpenAI client for tenants that bring their own key."""
+    unknown = set(config) - FIELDS
+    if unknown:
+        raise ValueError(f'tenant {phone_number_id}: unknown settings {", ".join(sorted(unknown))}')
+    name = config.get('name', phone_number_id)
+    openai_api_key = _secret(config, 'openai_api_key')
+    workers = int(config.get('workers', 0))
+    queue_size = int(config.get('queue_size', 1000))
+    graph_pool_size = int(config.get('graph_pool_size', graph.GRAPH_POOL_SIZE))
+    limits = ratelimit.Limits(
+        _limiter(config, 'sender_rate_per_minute', default.limits.sender, 'sender_burst', 5),
+        _limiter(config, 'number_rate_per_minute', default.limits.number, 'number_burst', 50),
+        default.limits.reply,
+    )
+    return Tenant(
+        name,
+        _secret(config, 'token') or default.token,
+        config.get('model', default.model),
+        config.get('system_prompt', default.system_prompt),
+        limits,
+        make_client(openai_api_key) if openai_api_key else default.client,
+        graph.create_session(graph_pool_size),
+        WorkerPool(workers, queue_size, name=f'worker-{name}') if workers > 0 else default.pool,
+        workers,
+        queue_size,
+        graph_pool_size,
+        openai_api_key,
+        bool(config.get('response_cache', default.response_cache)),
+    )
+
+
+def load(default, make_client):
+    """Tenants from TENANTS_FILE, or only default when it is unset."""
+    path = os.getenv('TENANTS_FILE')
+    if not path:
+        return Tenants(default)
+    with open(path) as f:
+        configs = json.load(f)
+    by_number = {
+        str(phone_number_id): from_config(str(phone_number_id), config, default, make_client)
+        for phone_number_id, config in configs.items()
+    }
+    names = [tenant.name for tenant in by_number.values()] + [default.name]
+    if len(set(names)) != len(names):
+        raise ValueError('tenant names must be unique')
+    return Tenants(default, by_number)
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import debounce  # noqa: E402
+
+KEY = ('1234', '15550001111')
+
+
+class SharedWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'debounce.sqlite3')
+        # Two coalescers on one file stand in for two worker processes.
+        self.first = debounce.SQLiteCoalescer(path, 1.0, 5.0)
+        self.second = debounce.SQLiteCoalescer(path, 1.0, 5.0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_messages_to_either_process_share_one_window(self):
+        self.assertTrue(self.first.add(KEY, 'what are', message_id='wamid.1', now=100.0))
+        self.assertFalse(self.second.add(KEY, 'your hours', message_id='wamid.2', now=100.5))
+        self.assertEqual(len(self.second), 1)
+        self.assertEqual(self.first.remaining(KEY, now=101.0), 0.5)
+
+        pending = self.first.take(KEY, now=101.5)
+        self.assertEqual(pending.text, 'what are\nyour hours')
+        self.assertEqual(pending.message_id, 'wamid.1')
+        self.assertIsNone(self.second.take(KEY, now=101.5))
+
+    def test_opener_waits_for_a_window_pushed_back_elsewhere(self):
+        flushed = []
+        self.first.start(lambda key, pending: flushed.append(pending.text))
+        now = self.first.clock()
+        self.first.add(KEY, 'what are', now=now)
+        self.second.add(KEY, 'your hours', now=now + 0.5)
+
+        self.assertEqual(self.first.take_due(now=now + 1.0), [])
+        [(key, pending)] = self.first.take_due(now=now + 1.5)
+        self.assertEqual((key, pending.text), (KEY, 'what are\nyour hours'))
+
+    def test_window_left_by_an_exited_process_is_replaced(self):
+        self.first.add(KEY, 'lost', now=100.0)
+        with self.assertLogs('debounce', 'WARNING'):
+            self.assertTrue(self.second.add(KEY, 'hello', now=100.0 + 1.0 + debounce.SQLiteCoalescer.STALE_AFTER + 1))
+        self.assertEqual(self.second.take(KEY, now=200.0).texts, ['hello'])
+
+
+if __name__ == '__main__':
+    unittest.main()
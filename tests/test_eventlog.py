@@ -0,0 +1,88 @@
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import eventlog  # noqa: E402
+
+SENDER = '15550001111'
+# Everything users can put in a message that must not reach the logs.
+PERSONAL = [
+    SENDER, 'Jane Q. Doe', 'Jane', 'Doe', '1 Main Street', 'Springfield', '12345', 'jane@example.com',
+    'https://example.com/jane', '+1 555 000 2222', 'tax-return-2024.pdf', 'Order #991 for Jane', 'Deliver to the back door',
+    'refund-jane-991', 'Home', 'Acme Corp', '52.5200', '13.4050', 'Where is my parcel?',
+]
+
+
+def webhook(*messages):
+    return {
+        'object': 'whatsapp_business_account',
+        'entry': [{'id': '102290129340398', 'changes': [{'field': 'messages', 'value': {
+            'messaging_product': 'whatsapp',
+            'metadata': {'display_phone_number': '15550009999', 'phone_number_id': '106540352242922'},
+            'contacts': [{'profile': {'name': 'Jane Q. Doe'}, 'wa_id': SENDER}],
+            'messages': [
+                dict(message, id=f'wamid.{i}', timestamp='1700000000', **{'from': SENDER})
+                for i, message in enumerate(messages)
+            ],
+        }}]}],
+    }
+
+
+MESSAGES = [
+    {'type': 'text', 'text': {'body': 'Where is my parcel?'}},
+    {'type': 'contacts', 'contacts': [{
+        'name': {'formatted_name': 'Jane Q. Doe', 'first_name': 'Jane', 'last_name': 'Doe'},
+        'addresses': [{'street': '1 Main Street', 'city': 'Springfield', 'zip': '12345', 'type': 'HOME'}],
+        'emails': [{'email': 'jane@example.com', 'type': 'WORK'}],
+        'phones': [{'phone': '+1 555 000 2222', 'wa_id': '15550002222', 'type': 'CELL'}],
+        'org': {'company': 'Acme Corp'},
+        'urls': [{'url': 'https://example.com/jane', 'type': 'HOME'}],
+    }]},
+    {'type': 'location', 'location': {'latitude': 52.5200, 'longitude': 13.4050, 'name': 'Home', 'address': '1 Main Street'}},
+    {'type': 'document', 'document': {
+        'filename': 'tax-return-2024.pdf', 'mime_type': 'application/pdf', 'sha256': 'abc', 'id': '2154',
+    }},
+    {'type': 'interactive', 'interactive': {'type': 'list_reply', 'list_reply': {
+        'id': 'order-991', 'title': 'Order #991 for Jane', 'description': 'Deliver to the back door',
+    }}},
+    {'type': 'button', 'button': {'text': 'Refund', 'payload': 'refund-jane-991'}},
+]
+
+
+class RedactionTest(unittest.TestCase):
+    def setUp(self):
+        self.log = eventlog.EventLog(io.StringIO(), redaction_key=b'test')
+
+    def record(self, **fields):
+        return self.log.format(1700000000.0, 'webhook', fields)
+
+    def test_personal_data_is_not_logged(self):
+        line = self.record(payload=webhook(*MESSAGES))
+        for value in PERSONAL:
+            self.assertNotIn(value, line)
+        self.assertNotIn('52.52', line)
+
+    def test_structure_and_ids_are_kept(self):
+        record = json.loads(self.record(payload=webhook(*MESSAGES)))
+        value = record['payload']['entry'][0]['changes'][0]['value']
+        self.assertEqual(value['metadata']['phone_number_id'], '106540352242922')
+        self.assertEqual([m['type'] for m in value['messages']], [m['type'] for m in MESSAGES])
+        self.assertEqual(value['messages'][0]['id'], 'wamid.0')
+        self.assertEqual(value['messages'][0]['text']['body'], '<19 chars>')
+        self.assertEqual(value['messages'][3]['document']['mime_type'], 'application/pdf')
+        self.assertEqual(value['messages'][4]['interactive']['type'], 'list_reply')
+        # The same sender hashes the same way, so their events can be followed.
+        self.assertEqual(value['messages'][0]['from'], self.log.redact_phone(SENDER))
+        self.assertEqual(value['contacts'][0]['wa_id'], self.log.redact_phone(SENDER))
+
+    def test_fields_of_our_own_events_are_kept(self):
+        record = json.loads(self.record(reason='queue_full', messages=3))
+        self.assertEqual((record['reason'], record['messages']), ('queue_full', 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import inbox  # noqa: E402
+
+
+class CancelledFutureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'inbox.sqlite3')
+        self.box = inbox.Inbox(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_writer_survives_a_cancelled_put(self):
+        # Hold the write lock so the put is still queued when it is cancelled,
+        # as when INBOX_PUT_TIMEOUT runs out.
+        blocker = sqlite3.connect(self.path, isolation_level=None)
+        blocker.execute('BEGIN IMMEDIATE')
+        cancelled = self.box.put([('wamid.1', ['1234', '15550001111', 'hello'])])
+        self.assertTrue(cancelled.cancel())
+        blocker.execute('COMMIT')
+        blocker.close()
+
+        self.assertEqual(self.box.put([('wamid.2', ['1234', '15550001111', 'again'])]).result(5), 1)
+        self.assertTrue(any(thread.name == 'inbox' for thread in threading.enumerate()))
+        # The cancelled write was still made.
+        self.assertEqual(self.box.depth(), 2)
+
+    def test_cancelled_complete_is_still_committed(self):
+        self.box.put([('wamid.1', ['1234', '15550001111', 'hello'])]).result(5)
+        [item] = self.box.claim(1).result(5)
+        blocker = sqlite3.connect(self.path, isolation_level=None)
+        blocker.execute('BEGIN IMMEDIATE')
+        self.assertTrue(self.box.complete([item.row_id]).cancel())
+        blocker.execute('COMMIT')
+        blocker.close()
+
+        self.assertEqual(self.box.claim(1).result(5), [])
+        self.assertEqual(self.box.depth(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
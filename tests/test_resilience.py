@@ -0,0 +1,51 @@
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import resilience  # noqa: E402
+
+NO_RETRIES = resilience.RetryPolicy(max_retries=0)
+
+
+def failing(*transients):
+    """An operation raising each of transients in turn, forever."""
+    cycle = itertools.cycle(transients)
+
+    def operation():
+        raise next(cycle)
+    return operation
+
+
+class BreakerTest(unittest.TestCase):
+    def test_rate_limits_do_not_hide_failures(self):
+        # An outage mixing 500s and 429s must still open the breaker.
+        breaker = resilience.CircuitBreaker('test', failure_threshold=3)
+        operation = failing(resilience.Transient(), resilience.Transient(failure=False))
+        for _ in range(5):
+            resilience.call(operation, 'test', NO_RETRIES, breaker)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.failures, 3)
+
+    def test_unclassified_errors_do_not_reset_failures(self):
+        breaker = resilience.CircuitBreaker('test', failure_threshold=3)
+        resilience.call(failing(resilience.Transient()), 'test', NO_RETRIES, breaker)
+        with self.assertRaises(ValueError):
+            resilience.call(failing(ValueError()), 'test', NO_RETRIES, breaker)
+        self.assertEqual(breaker.failures, 1)
+
+    def test_neutral_trial_lets_the_next_call_decide(self):
+        breaker = resilience.CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        resilience.call(failing(resilience.Transient()), 'test', NO_RETRIES, breaker)
+        breaker.reset_timeout = 60
+        breaker._opened_at -= 60
+        resilience.call(failing(resilience.Transient(failure=False)), 'test', NO_RETRIES, breaker)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertEqual(resilience.call(lambda: 'answer', 'test', NO_RETRIES, breaker), 'answer')
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
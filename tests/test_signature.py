@@ -0,0 +1,56 @@
+import hashlib
+import hmac
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import signature  # noqa: E402
+
+BODY = b'{"object": "whatsapp_business_account", "entry": []}'
+
+
+def sign(body, secret):
+    # Computed independently of signature.sign() so a bug there is caught.
+    return 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+class VerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.verifier = signature.Verifier(['new-secret', 'old-secret'])
+
+    def test_valid_signature_is_accepted(self):
+        self.assertIsNone(self.verifier.check(BODY, sign(BODY, b'new-secret')))
+        self.assertTrue(self.verifier.verify(BODY, sign(BODY, b'new-secret')))
+
+    def test_body_signed_with_the_rotated_secret_is_accepted(self):
+        self.assertIsNone(self.verifier.check(BODY, sign(BODY, b'old-secret')))
+
+    def test_missing_header_is_rejected(self):
+        self.assertEqual(self.verifier.check(BODY, None), 'missing')
+        self.assertEqual(self.verifier.check(BODY, ''), 'missing')
+        self.assertFalse(self.verifier.verify(BODY, None))
+
+    def test_malformed_header_is_rejected(self):
+        digest = sign(BODY, b'new-secret')
+        self.assertEqual(self.verifier.check(BODY, digest[len('sha256='):]), 'malformed')
+        self.assertEqual(self.verifier.check(BODY, 'sha1=' + digest[len('sha256='):]), 'malformed')
+        self.assertEqual(self.verifier.check(BODY, digest[:-1]), 'malformed')
+
+    def test_mismatched_signature_is_rejected(self):
+        self.assertEqual(self.verifier.check(BODY, sign(BODY, b'other-secret')), 'mismatch')
+        self.assertEqual(self.verifier.check(BODY + b' ', sign(BODY, b'new-secret')), 'mismatch')
+        self.assertFalse(self.verifier.verify(BODY, sign(BODY, b'other-secret')))
+
+    def test_secrets_come_from_app_secret(self):
+        with mock.patch.dict(os.environ, {'APP_SECRET': 'new-secret, old-secret'}):
+            verifier = signature.create_verifier()
+        self.assertIsNone(verifier.check(BODY, sign(BODY, b'old-secret')))
+        with mock.patch.dict(os.environ, {'APP_SECRET': ''}):
+            self.assertIsNone(signature.create_verifier())
+
+
+if __name__ == '__main__':
+    unittest.main()
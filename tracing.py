@@ -0,0 +1,122 @@
+"""Spans for the webhook, the completion and each Graph send, in Chrome trace format.
+
+Every span carries a request id derived from the WhatsApp message id
+(wamid), so one user message can be followed from webhook to reply. Spans
+are written as async begin/end events grouped by that id, which
+chrome://tracing and https://ui.perfetto.dev open directly. Writing goes
+through an eventlog.EventLog writer thread, so tracing never blocks a request.
+
+With TRACE_FILE unset, span() returns a shared no-op context manager.
+"""
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+
+import eventlog
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+
+def request_id_for(message_id):
+    return hashlib.blake2b(str(message_id).encode(), digest_size=8).hexdigest()
+
+
+class TraceFile(eventlog.EventLog):
+    """A JSON array of trace events. The closing bracket is optional in
+    this format, so events are simply appended."""
+
+    def __init__(self, path, queue_size=10000):
+        super().__init__(queue_size=queue_size)
+        self.path = path
+        self._file = None
+        self._file_pid = None
+
+    def open_stream(self):
+        # Opened on the writer thread, once per process; '{pid}' in the
+        # path gives each gunicorn or uvicorn worker its own file.
+        if self._file_pid != os.getpid():
+            self._file = open(self.path.format(pid=os.getpid()), 'a', buffering=1 << 16)
+            if self._file.tell() == 0:
+                self._file.write('[\n')
+            self._file_pid = os.getpid()
+        return self._file
+
+    def format(self, ts, event, fields):
+        common = {'name': event, 'cat': 'whatsapp', 'id': fields['request_id'], 'pid': fields.pop('pid'),
+                  'tid': fields.pop('tid')}
+        start = fields.pop('start')
+        begin = dict(common, ph='b', ts=start, args=fields)
+        end = dict(common, ph='e', ts=start + fields.pop('dur'))
+        return json.dumps(begin, default=str) + ',\n' + json.dumps(end) + ','
+
+
+class Span:
+    __slots__ = ('name', 'message_id', 'args', '_start', '_perf', '_token')
+
+    def __init__(self, name, message_id=None, args=None):
+        self.name = name
+        # May also be set inside the block, e.g. once the webhook is parsed.
+        self.message_id = message_id
+        self.args = args or {}
+        self._token = None
+
+    def __enter__(self):
+        if self.message_id is not None:
+            self._token = _request_id.set(request_id_for(self.message_id))
+        self._start = time.time()
+        self._perf = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._perf
+        if self._token is not None:
+            request_id = _request_id.get()
+            _request_id.reset(self._token)
+        elif self.message_id is not None:
+            request_id = request_id_for(self.message_id)
+        else:
+            request_id = _request_id.get() or os.urandom(8).hex()
+        if not sampled(request_id):
+            return False
+        fields = dict(self.args, request_id=request_id, pid=os.getpid(), tid=threading.get_ident(),
+                      start=int(self._start * 1e6), dur=int(duration * 1e6))
+        if self.message_id is not None:
+            fields['message_id'] = self.message_id
+        if exc_type is not None:
+            fields['error'] = exc_type.__name__
+        tracer.log(self.name, **fields)
+        return False
+
+
+def sampled(request_id):
+    # Decided by the id, so a message's spans are all kept or all dropped.
+    return SAMPLE_RATE >= 1.0 or int(request_id[:8], 16) < SAMPLE_RATE * 0x100000000
+
+
+class NullSpan:
+    """Stands in for Span when tracing is off; attributes set on it are ignored."""
+    message_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL = NullSpan()
+
+
+def span(name, message_id=None, **args):
+    """Context manager timing one span; a no-op when tracing is off."""
+    if tracer is None:
+        return _NULL
+    return Span(name, message_id, args)
+
+
+TRACE_FILE = os.getenv('TRACE_FILE')
+SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1'))
+tracer = TraceFile(TRACE_FILE, int(os.getenv('TRACE_QUEUE_SIZE', '10000'))) if TRACE_FILE else None
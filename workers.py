@@ -0,0 +1,82 @@
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PerProcess:
+    """Calls start() on first use in each process. Threads do not survive
+    fork(), so a child forked from a started parent (gunicorn --preload)
+    starts its own. start() should also make new queues and conditions for
+    them: the parent's threads are still listed as waiting on the old ones
+    and would swallow the child's first notify."""
+
+    def __init__(self, start):
+        self._start = start
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+                self._pid = os.getpid()
+
+
+class WorkerPool:
+    """Fixed set of daemon threads draining a bounded job queue."""
+
+    def __init__(self, workers, queue_size=0, name='worker'):
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._ensure_started = PerProcess(self._start)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args):
+        # Never block the caller: a full queue is reported back so the
+        # webhook can ask Meta to redeliver later instead of hanging.
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((fn, args))
+        except queue.Full:
+            return False
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def full(self):
+        return self._queue.full()
+
+    def shutdown(self, wait=True):
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except Exception:
+                logger.exception('background job failed')
+            finally:
+                self._queue.task_done()